@@ -1,85 +1,520 @@
+import os
+import json
+import math
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from collections import OrderedDict
+import numpy as np
 import pybikes
 import schedule
 
-bike_info = {}
-to_update = []
+from .geo import SphereIndex, EARTH_RADIUS, haversine
+from .snapshot import CitySnapshot
+from .demand import DemandTracker
+from .history import AvailabilityHistory
+from .forecast import Forecaster
+
+# the bots of the languages share the working directory, each one keeps its files in its own directories
+LANGUAGE = os.environ.get('BOT_LANGUAGE', 'EN')
+
+# days of availability history kept for each station, and the min seconds between samples
+HISTORY_DAYS = float(os.environ.get('HISTORY_DAYS', 7))
+HISTORY_SAMPLE_INTERVAL = float(os.environ.get('HISTORY_SAMPLE_INTERVAL', 300))
+# where the history is saved periodically, empty to disable
+HISTORY_DIR = os.environ.get('HISTORY_DIR', os.path.join('history', LANGUAGE))
+
+# where the forecast models are read from (see run_forecast_training.py)
+FORECAST_DIR = os.environ.get('FORECAST_DIR', 'forecast')
+# how many of the nearest stations are considered when ranking by the forecast
+FORECAST_CANDIDATES = int(os.environ.get('FORECAST_CANDIDATES', 5))
+# how many stations are considered at each end of a trip
+TRIP_CANDIDATES = int(os.environ.get('TRIP_CANDIDATES', 8))
+
+# where the last snapshots of the tracked cities are saved to answer immediately after a restart, empty to disable
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join('snapshots', LANGUAGE))
+
+# size in degrees of the cells of the memo of the city of the positions, and how many cells it keeps
+CITY_MEMO_CELL = float(os.environ.get('CITY_MEMO_CELL', 0.01))
+CITY_MEMO_SIZE = int(os.environ.get('CITY_MEMO_SIZE', 100000))
+
+# meters from its center within which a position is in a city whose stations are not known yet,
+# and the margin added around the stations of the known ones
+CITY_RADIUS = float(os.environ.get('CITY_RADIUS', 15000))
+CITY_MARGIN = float(os.environ.get('CITY_MARGIN', 1000))
+
+# where to keep the list of the cities between restarts, empty to disable
+CITY_INDEX_CACHE = os.environ.get('CITY_INDEX_CACHE', 'cities.cache.json')
+
+# how many feeds can be downloaded at the same time
+REFRESH_WORKERS = int(os.environ.get('BIKES_REFRESH_WORKERS', 8))
+# seconds after which the refresh of a city is abandoned
+REFRESH_TIMEOUT = float(os.environ.get('BIKES_REFRESH_TIMEOUT', 20))
+# seconds after which the data of a city is refreshed in background when it is requested
+MAX_AGE = float(os.environ.get('BIKES_MAX_AGE', 120))
+# seconds after which the data of a city is too old to be answered, the caller waits for the refresh
+MAX_STALE_AGE = float(os.environ.get('BIKES_MAX_STALE_AGE', 1800))
+# seconds before retrying a city whose refresh failed, doubled at each consecutive failure up to the max
+RETRY_BACKOFF = float(os.environ.get('BIKES_RETRY_BACKOFF', 30))
+MAX_RETRY_BACKOFF = float(os.environ.get('BIKES_MAX_RETRY_BACKOFF', 900))
+# bounds of the refresh interval of each city, that depends on its demand
+MIN_INTERVAL = float(os.environ.get('BIKES_MIN_INTERVAL', 30))
+MAX_STALENESS = float(os.environ.get('BIKES_MAX_STALENESS', 600))
+# seconds without queries after which a city is not tracked anymore
+IDLE_TTL = float(os.environ.get('BIKES_IDLE_TTL', 24 * 3600))
 
-def search_nearest(position, search_type):
+refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+# tag -> {time, duration, error} of the last refresh of each city
+refresh_stats = {}
+# tag -> how many refreshes of the city failed in a row
+refresh_failures = {}
+# tag -> Future of the refresh in progress, the concurrent requests for a city share it
+inflight = {}
+# tag -> time when its refresh in progress started
+refresh_started = {}
 
+# where the systems and their stations come from: pybikes, or an object with the
+# same functions (see fixtures.FixtureFeed), set with use_feed
+feed = pybikes
+
+# all the bike sharing systems known by the feed, loaded at startup
+city_tags = []
+city_metas = []
+city_index = SphereIndex([], [])
+# tag -> position in city_tags
+city_ids = {}
+# tag -> meters from its center that the stations of the city cover, see supported_city
+city_extents = {}
+# (lat cell, lng cell) -> (tag, meta) of the nearest city, least recently used first
+city_memo = OrderedDict()
+memo_lock = threading.Lock()
+
+# called with the changed stations of each refresh, see add_change_listener
+change_listeners = []
+
+# tag -> CitySnapshot of the city. The readers do not lock: the dict is never
+# modified, to publish a snapshot the whole dict is replaced
+bike_info = {}
+# the versions given to the snapshots, and the last one published
+versions = itertools.count(1)
+version = 0
+# the tags of the cities to keep refreshed
+to_update = set()
+# protects inflight, to_update and the replacement of bike_info
+cache_lock = threading.Lock()
+demand = DemandTracker(MIN_INTERVAL, MAX_STALENESS, IDLE_TTL)
+history = AvailabilityHistory(HISTORY_DAYS, HISTORY_SAMPLE_INTERVAL)
+forecaster = Forecaster()
+# tag -> time of the snapshot saved in SNAPSHOT_DIR
+saved_times = {}
+
+def search_nearest(position, search_type, arrival_minutes=None):
+    """
+    The city and the station nearest to the position with bikes (search_type
+    'bikes') or free slots (otherwise). If arrival_minutes is given, the
+    station is the nearest one that is predicted to still have them at arrival.
+    """
     info = get_city_cached(position)
 
-    if not info:
+    if info is None:
         return None, None
 
-    if search_type == 'bikes':
-        results_set = info['with_bikes']
+    if arrival_minutes is None:
+        return info.city, info.nearest(position, search_type)
 
-    else:
-        results_set = info['with_slots']
+    candidates = info.k_nearest(position, search_type, FORECAST_CANDIDATES)
+    if not candidates:
+        return info.city, None
+    predicted = forecaster.predict(info, candidates, search_type, arrival_minutes)
+    for station, count in zip(candidates, predicted):
+        if count >= 1:
+            return info.city, station
+    # none of them is expected to have any, take the most promising
+    return info.city, candidates[int(np.argmax(predicted))]
+
+
+def search_k_nearest(position, search_type, k, min_count=1):
+    """
+    The city and the list of the k stations nearest to the position that have
+    at least min_count bikes (search_type 'bikes') or free slots (otherwise),
+    sorted by distance. Each station has its distance in meters.
+    """
+    info = get_city_cached(position)
+
+    if info is None:
+        return None, []
+
+    return info.city, info.k_nearest(position, search_type, k, min_count)
+
+def search_trip(loc_from, loc_to, bike_speed, walk_speed, k=TRIP_CANDIDATES):
+    """
+    The snapshots of the cities and the pair of stations (source with bikes,
+    destination with free slots at arrival) that make the trip from loc_from
+    to loc_to fastest: walking to the source, riding to the destination and
+    walking from it. The speeds are in km/h.
+    Returns info_from, info_to, source, destination.
+    """
+    info_from = get_city_cached(loc_from)
+    info_to = get_city_cached(loc_to)
+    if info_from is None or info_to is None or info_from.tag != info_to.tag:
+        # no trip inside a single city, each end on its own
+        source = info_from.nearest(loc_from, 'bikes') if info_from is not None else None
+        destination = info_to.nearest(loc_to, 'slots') if info_to is not None else None
+        return info_from, info_to, source, destination
+
+    # a refresh may have been published between the two, the ids are of a single snapshot
+    info = info_from = info_to
+    sources = info.k_nearest(loc_from, 'bikes', k)
+    destinations = info.k_nearest(loc_to, 'slots', k)
+    if not sources or not destinations:
+        return info_from, info_to, sources[0] if sources else None, destinations[0] if destinations else None
+
+    # the slot is needed when the user arrives, not now
+    trip_minutes = haversine(loc_from['latitude'], loc_from['longitude'], loc_to['latitude'], loc_to['longitude']) / 1000 / bike_speed * 60
+    predicted = forecaster.predict(info, destinations, 'slots', trip_minutes)
+    if (predicted >= 1).any():
+        destinations = [x for x, count in zip(destinations, predicted) if count >= 1]
+
+    # seconds per meter
+    walk_pace = 3.6 / walk_speed
+    bike_pace = 3.6 / bike_speed
+    source_ids = np.array([x.id for x in sources])
+    destination_ids = np.array([x.id for x in destinations])
+    walk = (np.array([x.distance for x in sources])[:, None] +
+            np.array([x.distance for x in destinations])[None, :]) * walk_pace
+    ride = haversine(info.lat[source_ids][:, None], info.lng[source_ids][:, None],
+                     info.lat[destination_ids][None, :], info.lng[destination_ids][None, :]) * bike_pace
+    cost = walk + ride
+    # taking and leaving the bike at the same station is not a trip
+    cost[source_ids[:, None] == destination_ids[None, :]] = np.inf
+    if not np.isfinite(cost).any():
+        return info_from, info_to, sources[0], destinations[0]
+    i, j = np.unravel_index(int(np.argmin(cost)), cost.shape)
+    return info_from, info_to, sources[i], destinations[j]
+
+
+def search_within(position, radius):
+    """
+    The tag of the city and the list of all the stations within radius meters
+    from the position, sorted by distance, whatever their availability
+    """
+    info = get_city_cached(position)
+
+    if info is None:
+        return None, []
+
+    return info.tag, info.within(position, radius)
+
+
+def fetch_city(tag):
+    """Downloads the stations of a single city and builds its snapshot"""
+    scraper = feed.PyBikesScraper()
+    # a hung feed must not keep a worker forever
+    scraper.requests_timeout = REFRESH_TIMEOUT
+    bikeshare = feed.get(tag)
+    bikeshare.update(scraper)
+
+    # what did not change is shared with the current snapshot
+    return CitySnapshot.from_stations(tag, bikeshare.meta['city'], time.time(), bikeshare.stations, next(versions),
+                                      bike_info.get(tag, None))
+
+
+def refresh_city(tag):
+    """
+    Starts the refresh of a city in background, unless one is already in
+    progress. Returns the future of the info of the city.
+    """
+    with cache_lock:
+        future = inflight.get(tag, None)
+        if future is None:
+            future = refresh_executor.submit(__refresh, tag)
+            inflight[tag] = future
+        return future
+
+
+def publish(info):
+    """
+    Makes the snapshot visible to the readers, in place of the previous one of
+    its city. Returns the previous one. Nothing changes if the city is not
+    tracked anymore or has a newer snapshot already.
+    """
+    global bike_info, version
+    with cache_lock:
+        previous = bike_info.get(info.tag, None)
+        if info.tag in to_update and (previous is None or previous.version < info.version):
+            bike_info = {**bike_info, info.tag: info}
+            version = max(version, info.version)
+    return previous
+
+
+def city_version(tag):
+    """The version of the snapshot of the city, None if it is not known"""
+    info = bike_info.get(tag, None)
+    return info.version if info is not None else None
+
+
+def __refresh(tag):
+    """Executed on the refresh pool: downloads the city and publishes its info"""
+    started = refresh_started[tag] = time.time()
+    try:
+        info = fetch_city(tag)
+        duration = time.time() - started
+        refresh_stats[tag] = {'time': started, 'duration': duration, 'error': None}
+        refresh_failures.pop(tag, None)
+        print('refreshed {} in {:.2f}s'.format(tag, duration))
+        previous = publish(info)
+        if previous is None or previous.names is not info.names:
+            update_extent(info)
+        if previous is not None:
+            changed = info.changed(previous)
+            fraction = np.count_nonzero(changed) / len(info) if len(info) else 0.0
+            demand.record_refresh(tag, fraction, info.time - previous.time)
+            if change_listeners and changed.any() and bike_info.get(tag, None) is info:
+                notify_changes(info, info.changes(previous, changed))
+        history.record(info)
+        return info
+    except Exception as e:
+        refresh_stats[tag] = {'time': started, 'duration': time.time() - started, 'error': str(e)}
+        refresh_failures[tag] = refresh_failures.get(tag, 0) + 1
+        print('something bad while getting info for ' + tag + ': ' + str(e))
+        raise
+    finally:
+        with cache_lock:
+            inflight.pop(tag, None)
+            refresh_started.pop(tag, None)
+
+
+def add_change_listener(listener):
+    """
+    listener(info, changes) is called on the refresh pool each time a city is
+    published with stations that changed since its previous snapshot, with the
+    new snapshot and the list of the snapshot.Change of those stations
+    """
+    change_listeners.append(listener)
+
+
+def notify_changes(info, changes):
+    for listener in change_listeners:
+        try:
+            listener(info, changes)
+        except Exception as e:
+            print('something bad in a change listener of {}: {}'.format(info.tag, e))
+
+
+def search_nearest_many(positions, search_type, min_count=1):
+    """
+    Bulk version of search_nearest. positions is an array-like of (latitude,
+    longitude) rows, possibly in different cities. Returns three arrays with an
+    element for each position: the tag of its city, the id of the nearest
+    station in the snapshot of that city (-1 if none) and the distance in meters
+    (NaN if none). The station can be read with bike_info[tag].station(id).
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    tags = np.full(len(positions), None, dtype=object)
+    ids = np.full(len(positions), -1, dtype=np.int64)
+    distances = np.full(len(positions), np.nan)
+    if not len(positions):
+        return tags, ids, distances
 
-    distance_sq = float('inf')
-    best = -1
-    #print("results_set has size: " + str(len(results_set)))
-    for idx, val in enumerate(results_set):
-        d2 = (position['latitude']-val.latitude) **2 + (position['longitude']-val.longitude) **2
-        if d2 < distance_sq:
-            distance_sq = d2
-            best = idx
+    # group the positions by their nearest city, then one vectorized query for each city
+    cities_of, _ = city_index.nearest_many(positions[:, 0], positions[:, 1])
+    cities = [city for city in np.unique(cities_of).tolist() if city >= 0]
+    # the missing cities are all requested before waiting, so they are downloaded concurrently
+    requested = {city: __request_city(city_tags[city]) for city in cities}
+    deadline = time.time() + REFRESH_TIMEOUT
+    for city in cities:
+        members = np.nonzero(cities_of == city)[0]
+        tag = city_tags[city]
+        tags[members] = tag
+        info, future = requested[city]
+        if future is not None:
+            info = __wait_city(tag, future, max(deadline - time.time(), 0))
+        if info is None:
+            continue
+        ids[members], distances[members] = info.index.nearest_many(
+            positions[members, 0], positions[members, 1], info.with_at_least(search_type, min_count))
 
-    if best is -1:
-        return info['city'], None
+    return tags, ids, distances
 
-    return info['city'], results_set[best]
 
-# working on global variables?? SRSLY?
 def update_data(which_to_update):
+    """
+    Refreshes the cities concurrently on the refresh pool. Returns the info of
+    the cities that have been refreshed, the ones that failed or did not finish
+    within REFRESH_TIMEOUT seconds are left out and reported in refresh_stats.
+    """
     print('update_data called on : ' + str(which_to_update))
     result = {}
-    for value in which_to_update:
-        print('going to get info on ' + value)
-        try:
-            bikeshare = pybikes.get(value)
-            bikeshare.update()
+    futures = {refresh_city(tag): tag for tag in set(which_to_update)}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        now = time.time()
+        for future in done:
+            if not future.exception():
+                result[futures[future]] = future.result()
+        for future in list(pending):
+            tag = futures[future]
+            started = refresh_started.get(tag, None)
+            # the timeout counts from when the download started, not from when it was queued
+            if started and now - started > REFRESH_TIMEOUT:
+                # the thread cannot be stopped, it will end with the scraper timeout
+                pending.discard(future)
+                refresh_stats[tag] = {'time': started, 'duration': now - started, 'error': 'timeout'}
+                print('timeout while getting info for ' + tag)
 
-            result[value] = {
-                'city': bikeshare.meta['city'],
-                'stations': {x.name:x for x in bikeshare.stations},
-                'with_bikes': [station for station in bikeshare.stations if station.bikes and station.bikes>0],
-                'with_slots': [station for station in bikeshare.stations if station.free and station.free>0]
-            }
+    return result
 
-        except Exception as e:
-            print('something bad while getting info for ' + value + ': ' + str(e) + '\n, discarding this city')
-            which_to_update.remove(value)
 
+def get_city_cached(position):
+    """
+    The info of the city of the position. A city already known is returned
+    immediately, and if it is older than MAX_AGE it is refreshed in background.
+    Only on a miss the caller waits, for the download of that city only.
+    """
+    tag, _ = nearest_city_find(position)
+    if tag is None:
+        return None
 
+    return get_city(tag)
+
+
+def backing_off(tag, now=None):
+    """True if the last refresh of the city failed too recently to try again"""
+    stats = refresh_stats.get(tag, None)
+    if not stats or not stats['error']:
+        return False
+    failures = max(refresh_failures.get(tag, 1), 1)
+    backoff = min(RETRY_BACKOFF * 2 ** (failures - 1), MAX_RETRY_BACKOFF)
+    return (now or time.time()) - stats['time'] < backoff
 
-    return result
 
+def get_city(tag):
     """
-    torino_bikeshare = pybikes.get('to-bike')
-    torino_bikeshare.update()
-    torino_stations = {x.name:x for x in torino_bikeshare.stations}
-    stations_with_bikes = [station for station in torino_bikeshare.stations if station.bikes>0]
-    stations_with_free = [station for station in torino_bikeshare.stations if station.free>0]"""
+    The snapshot of the city with the tag, see get_city_cached. A snapshot
+    older than MAX_STALE_AGE is not returned: the caller waits for the
+    refresh, and gets None if it fails or the city is backing off.
+    """
+    result, future = __request_city(tag)
+    if future is None:
+        return result
+    return __wait_city(tag, future, REFRESH_TIMEOUT)
 
-def get_city_cached(position):
-    global bike_info, to_update
 
-    tag, _ = nearest_city_find(position)
+def __request_city(tag):
+    """
+    The first half of get_city, that does not wait: returns (snapshot, None)
+    if the city can be answered now, otherwise (None, the future of its refresh).
+    """
+    demand.record_query(tag)
+    now = time.time()
     result = bike_info.get(tag, None)
-    if not result:
-        to_update.append(tag)
-        bike_info = update_data(to_update)
-        # now the city must be there or something bad happened
-        result = bike_info.get(tag, None)
+    if result is not None:
+        age = now - result.time
+        if age <= MAX_AGE:
+            return result, None
+        if backing_off(tag, now):
+            return (result if age <= MAX_STALE_AGE else None), None
+        future = refresh_city(tag)
+        if age <= MAX_STALE_AGE:
+            return result, None
+    else:
+        if backing_off(tag, now):
+            return None, None
+        with cache_lock:
+            to_update.add(tag)
+        future = refresh_city(tag)
+    return None, future
+
+
+def __wait_city(tag, future, timeout):
+    """The second half of get_city: waits at most timeout seconds for the refresh of the city"""
+    result = None
+    try:
+        result = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        print('timeout while waiting for ' + tag)
+    except Exception:
+        # already reported by the refresh
+        pass
 
+    if result is None:
+        with cache_lock:
+            if tag not in bike_info:
+                # stop tracking a city that cannot be downloaded
+                to_update.discard(tag)
     return result
 
+
 def nearest_city_find(position):
-    where_to_search = {}
-    for schema in pybikes.get_all_data():
-        data = pybikes.get_data(schema)
+    """
+    The tag and the meta of the bike sharing system nearest to the position.
+    The result is memoized for the cell of CITY_MEMO_CELL degrees that contains
+    the position, when the same city is the nearest for the whole cell.
+    """
+    latitude, longitude = position['latitude'], position['longitude']
+    key = (math.floor(latitude / CITY_MEMO_CELL), math.floor(longitude / CITY_MEMO_CELL))
+    memo = city_memo
+    with memo_lock:
+        result = memo.get(key, None)
+        if result is not None:
+            memo.move_to_end(key)
+            return result
+
+    tags, metas, index = city_tags, city_metas, city_index
+    # the two nearest cities from the center of the cell
+    center = ((key[0] + 0.5) * CITY_MEMO_CELL, (key[1] + 0.5) * CITY_MEMO_CELL)
+    best, distances = index.k_nearest(center[0], center[1], 2)
+    if not len(best):
+        return None, None
+    # any point of the cell is within this distance from the center
+    radius = math.radians(CITY_MEMO_CELL) * EARTH_RADIUS * math.sqrt(2) / 2
+    if len(best) == 1 or distances[1] - distances[0] > 2 * radius:
+        # the first is the nearest from all the points of the cell
+        result = tags[best[0]], metas[best[0]]
+        with memo_lock:
+            memo[key] = result
+            if len(memo) > CITY_MEMO_SIZE:
+                memo.popitem(last=False)
+        return result
+
+    # near the border between two cities, the cell cannot be memoized
+    best, _ = index.nearest(latitude, longitude)
+    return tags[best], metas[best]
+
+
+def update_extent(info):
+    """Computes the extent of the city from the positions of its stations"""
+    i = city_ids.get(info.tag, None)
+    if i is None or not len(info):
+        return
+    meta = city_metas[i]
+    distances = haversine(float(meta['latitude']), float(meta['longitude']), info.lat, info.lng)
+    # a few stations of some feeds have wrong positions
+    city_extents[info.tag] = float(np.percentile(distances, 99)) + CITY_MARGIN
+
+
+def supported_city(position):
+    """
+    The tag and the meta of the bike sharing system nearest to the position,
+    and whether the position is inside it: within the extent of its stations
+    if they are known, otherwise within CITY_RADIUS from its center.
+    Answered in memory, from the metas of pybikes and the known stations.
+    """
+    tag, meta = nearest_city_find(position)
+    if tag is None:
+        return None, None, False
+    distance = haversine(position['latitude'], position['longitude'], float(meta['latitude']), float(meta['longitude']))
+    return tag, meta, bool(distance <= city_extents.get(tag, CITY_RADIUS))
+
+
+def read_pybikes_instances():
+    """Walks the data files of the feed, returns the list of (tag, meta) of all the instances"""
+    result = []
+    for schema in feed.get_all_data():
+        data = feed.get_data(schema)
         instances = data.get('instances', None)
         if not instances:
             instances = []
@@ -87,31 +522,153 @@ def nearest_city_find(position):
                 instances.extend(value['instances'])
 
         for instance in instances:
-            where_to_search[instance['tag']] = instance['meta']
+            result.append((instance['tag'], instance['meta']))
+
+    return result
+
+
+def load_cities(cache_path=CITY_INDEX_CACHE):
+    """
+    Builds the index of the cities. The data files of the feed are read only if
+    the cache is missing or was made from a different set of files.
+    """
+    global city_tags, city_metas, city_index, city_memo, city_ids
+    cache_key = '{} {}'.format(getattr(feed, '__version__', ''), sorted(feed.get_all_data()))
+    instances = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['key'] == cache_key:
+                instances = cached['instances']
+        except Exception as e:
+            print('discarding the cities cache: ' + str(e))
+
+    if instances is None:
+        instances = read_pybikes_instances()
+        if cache_path:
+            try:
+                with open(cache_path, 'w') as f:
+                    json.dump({'key': cache_key, 'instances': instances}, f)
+            except OSError as e:
+                print('cannot write the cities cache: ' + str(e))
 
-    # now where_to_search contains a map (tag, {latitude, longitude, ...})
-    #pprint(where_to_search)
+    # a tag may appear more than once, keep the last one as the dict did before
+    by_tag = {tag: meta for tag, meta in instances
+              if meta.get('latitude') is not None and meta.get('longitude') is not None}
+    tags = list(by_tag.keys())
+    metas = [by_tag[tag] for tag in tags]
+    index = SphereIndex([float(m['latitude']) for m in metas], [float(m['longitude']) for m in metas])
+    # swap them together, readers use the globals. The memo of the old list is dropped
+    city_tags, city_metas, city_index, city_memo, city_ids = tags, metas, index, OrderedDict(), {tag: i for i, tag in enumerate(tags)}
+    print('loaded {} bike sharing systems'.format(len(tags)))
 
-    distance_sq = float('inf')
-    best = -1
-    #print("results_set has size: " + str(len(results_set)))
-    for key, value in where_to_search.items():
-        d2 = (position['latitude']-value['latitude']) **2 + (position['longitude']-value['longitude']) **2
-        if d2 < distance_sq:
-            distance_sq = d2
-            best = key
 
-    #print("nearest is " + best)
-    return best, where_to_search[best]
+def use_feed(new_feed, cache_path=None):
+    """
+    Replaces the source of the systems, e.g. with a fixtures.FixtureFeed to run
+    without network. The data of the previous feed is dropped.
+    """
+    global feed, bike_info
+    feed = new_feed
+    with cache_lock:
+        to_update.clear()
+        bike_info = {}
+    saved_times.clear()
+    load_cities(cache_path)
 
 
 def update():
+    """
+    Executed periodically by the scheduler: refreshes the cities whose data
+    is older than their refresh interval and stops tracking the idle ones.
+    """
     global bike_info
     try:
-        bike_info = update_data(to_update)
+        now = time.time()
+        for tag in demand.idle(now):
+            print('not tracking anymore the idle city ' + tag)
+            with cache_lock:
+                to_update.discard(tag)
+                bike_info = {key: value for key, value in bike_info.items() if key != tag}
+            demand.forget(tag)
+
+        with cache_lock:
+            tags = list(to_update)
+        due = [tag for tag in tags if (tag not in bike_info or now - bike_info[tag].time >= demand.interval(tag, now))
+               and not backing_off(tag, now)]
+        # not waited: the cities are published as they are refreshed, the ones that fail
+        # keep their previous data, and the scheduler can run the other jobs meanwhile
+        for tag in due:
+            refresh_city(tag)
 
     except Exception as e:
         print('something bad happened: ' + str(e))
 
-# schedule execution of update every minute
-schedule.every(1).minutes.do(update)
\ No newline at end of file
+def save_snapshots(path=SNAPSHOT_DIR):
+    """Writes the snapshots changed since the last save and the list of the tracked cities"""
+    try:
+        os.makedirs(path, exist_ok=True)
+        with cache_lock:
+            cities = {tag: bike_info[tag] for tag in to_update if tag in bike_info}
+        for tag, info in cities.items():
+            if saved_times.get(tag, None) != info.time:
+                info.save(os.path.join(path, tag + '.snapshot'))
+                saved_times[tag] = info.time
+        # the tracked cities with their last query, for the eviction of the idle ones
+        tracked = {tag: demand.last_query(tag) for tag in cities}
+        tmp_path = os.path.join(path, 'tracked.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(tracked, f)
+        os.replace(tmp_path, os.path.join(path, 'tracked.json'))
+    except Exception as e:
+        print('cannot save the snapshots: ' + str(e))
+
+
+def load_snapshots(path=SNAPSHOT_DIR):
+    """
+    Loads the snapshots saved before the restart: the cities are answered
+    immediately from them, and refreshed in background when they are due.
+    """
+    global bike_info, version
+    tracked_path = os.path.join(path, 'tracked.json')
+    if not os.path.exists(tracked_path):
+        return
+    with open(tracked_path) as f:
+        tracked = json.load(f)
+    loaded = {}
+    for tag, last_query in tracked.items():
+        try:
+            loaded[tag] = CitySnapshot.load(os.path.join(path, tag + '.snapshot'), next(versions))
+        except Exception as e:
+            print('discarding the snapshot of {}: {}'.format(tag, e))
+            continue
+        saved_times[tag] = loaded[tag].time
+        update_extent(loaded[tag])
+        demand.restore(tag, last_query or time.time())
+    with cache_lock:
+        to_update.update(loaded.keys())
+        bike_info = {**loaded, **bike_info}
+        version = max([version] + [info.version for info in loaded.values()])
+    print('loaded the snapshots of {} cities'.format(len(loaded)))
+
+
+def save_history():
+    try:
+        history.save(HISTORY_DIR)
+    except Exception as e:
+        print('cannot save the history: ' + str(e))
+
+
+load_cities()
+if SNAPSHOT_DIR:
+    load_snapshots()
+    schedule.every(1).minutes.do(save_snapshots)
+forecaster.load(FORECAST_DIR)
+schedule.every(1).hours.do(forecaster.load, FORECAST_DIR)
+if HISTORY_DIR:
+    history.load(HISTORY_DIR)
+    schedule.every(15).minutes.do(save_history)
+
+# check which cities have to be refreshed
+schedule.every(10).seconds.do(update)
@@ -1,22 +1,49 @@
 import os
 import time
-import requests
-
-from math import radians, cos, sin, asin, sqrt
+import schedule
+from concurrent.futures import ThreadPoolExecutor
 
 from . import bikes
 from .nlu import Nlu
 from . import persistence
 from . import personalization
 from . import output_sentences
+from . import http_client
+from .subscriptions import Subscriptions
+from .geocoding import GeocodingCache, normalize
+from .gazetteer import Gazetteer, read_places
 
 LANGUAGE = os.environ.get('BOT_LANGUAGE', 'EN')
 print('language is ' + LANGUAGE)
+# how many other stations are shown on the map after the nearest one
+ALTERNATIVE_STATIONS = int(os.environ.get('ALTERNATIVE_STATIONS', 2))
+# km/h, to estimate when a trip arrives at the destination
+BIKE_SPEED = float(os.environ.get('BIKE_SPEED', 15))
+# km/h, to weigh the walk to and from the stations of a trip
+WALK_SPEED = float(os.environ.get('WALK_SPEED', 5))
+# meters around the position of a search watched by a subscription, and how many seconds it lasts
+SUBSCRIPTION_RADIUS = float(os.environ.get('SUBSCRIPTION_RADIUS', 500))
+SUBSCRIPTION_TTL = float(os.environ.get('SUBSCRIPTION_TTL', 3600))
+# the text of the button to subscribe to the last search
+SUBSCRIBE_BUTTON = '🔔'
+# seconds the geocoding of a place is cached, and of a place not found
+GEOCODING_TTL = float(os.environ.get('GEOCODING_TTL', 30 * 86400))
+GEOCODING_NEGATIVE_TTL = float(os.environ.get('GEOCODING_NEGATIVE_TTL', 600))
+# degrees around the center of the city of the user where the places are searched first
+GEOCODING_BIAS = float(os.environ.get('GEOCODING_BIAS', 0.25))
+# CSV file of places (name, latitude, longitude) resolved without geocoding, empty for none
+GAZETTEER_FILE = os.environ.get('GAZETTEER_FILE', '')
+# threads for the independent requests made while answering a message
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 8))
 
 sendMessageFunction = None
 
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS)
+
 # chat contexts
 contexts = {}
+# chat_id -> {'location', 'search_type'} of the last search of bikes or slots, to subscribe to it
+last_searches = {}
 
 
 def process(msg, sendMessage):
@@ -63,6 +90,10 @@ def process(msg, sendMessage):
                 chat_id, output_sentences.get(LANGUAGE, 'THANK'))
             return
 
+        if msg['text'] == SUBSCRIBE_BUTTON:
+            subscribe(chat_id)
+            return
+
         # TODO this is to test facebook login
         if msg['text'] == 'login':
             sendMessageFunction(
@@ -157,7 +188,7 @@ def askPosition(chat_id):
     sendMessageFunction(chat_id, response, msg_type='request_location')
 
 
-def provideResult(chat_id, station, search_type, from_location, to_location=None, buttons=None):
+def provideResult(chat_id, station, search_type, from_location, to_location=None, buttons=None, alternatives=None):
     global sendMessageFunction
     if not station:
         response = output_sentences.get(LANGUAGE, 'ERROR_SEARCHING')
@@ -184,10 +215,12 @@ def provideResult(chat_id, station, search_type, from_location, to_location=None
             markers.append({'type': 'slot', 'value': {'lat': dst_station.latitude, 'lng': dst_station.longitude, 'name': dst_station.name}})
             sendMessageFunction(chat_id, response, msg_type='map', markers=markers, buttons=buttons)
         elif search_type == 'bikes':
-            markers.append({'type': 'bike', 'value': {'lat': station.latitude, 'lng': station.longitude, 'name': station.name}})
+            for result in [station] + (alternatives or []):
+                markers.append({'type': 'bike', 'value': {'lat': result.latitude, 'lng': result.longitude, 'name': result.name}})
             sendMessageFunction(chat_id, response, msg_type='map', markers=markers, buttons=buttons)
         elif search_type == 'slots':
-            markers.append({'type': 'slot', 'value': {'lat': station.latitude, 'lng': station.longitude, 'name': station.name}})
+            for result in [station] + (alternatives or []):
+                markers.append({'type': 'slot', 'value': {'lat': result.latitude, 'lng': result.longitude, 'name': result.name}})
             sendMessageFunction(chat_id, response, msg_type='map', markers=markers, buttons=buttons)
         else:
             sendMessageFunction(chat_id, response, buttons=buttons)
@@ -195,13 +228,41 @@ def provideResult(chat_id, station, search_type, from_location, to_location=None
         sendMessageFunction(chat_id, response, buttons=buttons)
 
 
-def search_place(place_name):
+def search_place(place_name, near=None):
+    """
+    The position of the place, {} if not found. If near is given, the places
+    in the bike sharing city nearest to it are preferred.
+    """
+    scope = meta = None
+    if near:
+        scope, meta = bikes.nearest_city_find(near)
+    # the cities, the stations and the imported places are known without asking
+    place = gazetteer.lookup(place_name, scope)
+    if place:
+        return {'latitude': place.latitude, 'longitude': place.longitude}
+
+    key = normalize(place_name, scope)
+    found, location = geocoding_cache.get(key)
+    if found:
+        # a copy, the callers can modify it
+        return dict(location) if location else {}
+
+    params = {'key': os.environ['MAPS_TOKEN'], 'address': place_name}
+    if meta:
+        latitude, longitude = float(meta['latitude']), float(meta['longitude'])
+        params['bounds'] = '{},{}|{},{}'.format(latitude - GEOCODING_BIAS, longitude - GEOCODING_BIAS,
+                                                latitude + GEOCODING_BIAS, longitude + GEOCODING_BIAS)
     result = {}
     try:
-        response = requests.get('https://maps.googleapis.com/maps/api/geocode/json?key=' +
-                                os.environ['MAPS_TOKEN'] + '&address=' + place_name).json()
+        response = http_client.get('geocoding', 'https://maps.googleapis.com/maps/api/geocode/json', params=params).json()
     except Exception:
         print(output_sentences.get(LANGUAGE, 'GEOCODING_ERROR').format(searched=place_name))
+        # not cached, it can be a temporary error
+        return result
+
+    if response.get('status', None) not in ('OK', 'ZERO_RESULTS'):
+        print('geocoding of {} failed: {}'.format(place_name, response.get('status', None)))
+        return result
 
     places_found = response['results']
 
@@ -211,9 +272,24 @@ def search_place(place_name):
         result['longitude'] = float(
             places_found[0]['geometry']['location']['lng'])
 
+    geocoding_cache.put(key, dict(result) if result else None)
     return result
 
 
+def update_gazetteer():
+    """Rebuilds the gazetteer when the cities or the tracked stations are different"""
+    global gazetteer, gazetteer_key
+    snapshots = list(bikes.bike_info.values())
+    # the names and positions of a city are shared by its snapshots until its stations
+    # change. The key keeps them alive, so the same objects mean the same stations
+    key = (bikes.city_metas, {info.tag: (info.names, info.lat, info.lng) for info in snapshots})
+    if (gazetteer_key is not None and key[0] is gazetteer_key[0] and key[1].keys() == gazetteer_key[1].keys()
+            and all(all(a is b for a, b in zip(value, gazetteer_key[1][tag])) for tag, value in key[1].items())):
+        return
+    gazetteer = Gazetteer.build(bikes.city_metas, snapshots, imported_places)
+    gazetteer_key = key
+
+
 def getEntity(entities, key):
     entity_obj = entities.get(key, None)
     if entity_obj:
@@ -233,7 +309,7 @@ def getLocation(chat_id, entities):
     user_position = persistence.get_position(chat_id)
 
     if location_name:
-        location = search_place(location_name)
+        location = search_place(location_name, near=user_position)
         if not location:
             response = output_sentences.get(LANGUAGE, 'GEOCODING_ERROR').format(searched=location_name)
             sendMessageFunction(chat_id, response)
@@ -270,36 +346,26 @@ def search_bike(chat_id, entities):
         save_context(chat_id, 'search_bike', entities)
         return
 
-    city, result = bikes.search_nearest(location, 'bikes')
-    provideResult(chat_id, result, 'bikes', location, buttons=askFeedback())
+    # the nearest one and some alternatives, in a single query
+    city, results = bikes.search_k_nearest(location, 'bikes', 1 + ALTERNATIVE_STATIONS)
+    result = results[0] if results else None
+    last_searches[chat_id] = {'location': location, 'search_type': 'bikes'}
+    provideResult(chat_id, result, 'bikes', location, buttons=askFeedback() + askSubscription(), alternatives=results[1:])
 
     return
     recommend(chat_id, [result])
 
-def haversine(lon1, lat1, lon2, lat2):
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    """
-    # convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    # haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    km = 6367 * c
-    return km
-
 def get_nearest_supported_city(chat_id, entities):
     global sendMessageFunction
     location = getLocation(chat_id, entities)
+    if not location:
+        askPosition(chat_id)
+        return
 
-    tag, meta = bikes.nearest_city_find(location)
-    supported_city_name = meta['city']
-    result_latlng = search_place(supported_city_name)
-    # is the city if distance < 500m
-    if (haversine(location['longitude'], location['latitude'], result_latlng['longitude'], result_latlng['latitude']) < 0.5):
+    tag, meta, inside = bikes.supported_city(location)
+    if tag is None:
+        response = output_sentences.get(LANGUAGE, 'ERROR_SEARCHING')
+    elif inside:
         response = output_sentences.get(LANGUAGE, 'SUPPORTED_AFFIRMATIVE').format(city=meta['city'])
     else:
         response = output_sentences.get(LANGUAGE, 'SUPPORTED_NEGATIVE').format(nearest_city=meta['city'])
@@ -313,28 +379,52 @@ def search_slot(chat_id, entities):
         save_context(chat_id, 'search_bike', entities)
         return
 
-    city, result = bikes.search_nearest(location, 'slots')
-    provideResult(chat_id, result, 'slots', location, buttons=askFeedback())
+    city, results = bikes.search_k_nearest(location, 'slots', 1 + ALTERNATIVE_STATIONS)
+    result = results[0] if results else None
+    last_searches[chat_id] = {'location': location, 'search_type': 'slots'}
+    provideResult(chat_id, result, 'slots', location, buttons=askFeedback() + askSubscription(), alternatives=results[1:])
 
     recommend(chat_id, [result])
 
 
 def plan_trip(chat_id, entities):
     global sendMessageFunction
-    location = getLocation(chat_id, entities)
+    location_str = getEntity(entities, 'location')
     loc_from_str = getEntity(entities, 'from')
     loc_to_str = getEntity(entities, 'to')
 
+    # the places are geocoded and their cities downloaded concurrently, only
+    # waiting for the position of the user that scopes the geocoding
+    user_position = io_executor.submit(persistence.get_position, chat_id)
+
+    def resolve(place_name):
+        place = search_place(place_name, near=user_position.result())
+        if place:
+            bikes.get_city_cached(place)
+        return place
+
+    location_future, loc_from_future, loc_to_future = [
+        io_executor.submit(resolve, place_name) if place_name else None
+        for place_name in (location_str, loc_from_str, loc_to_str)]
+
+    if location_future:
+        location = location_future.result()
+        if not location:
+            response = output_sentences.get(LANGUAGE, 'GEOCODING_ERROR').format(searched=location_str)
+            sendMessageFunction(chat_id, response)
+    else:
+        location = user_position.result()
+
     loc_from = loc_to = None
 
-    if loc_from_str:
-        loc_from = search_place(loc_from_str)
+    if loc_from_future:
+        loc_from = loc_from_future.result()
         if not loc_from:
             response = output_sentences.get(LANGUAGE, 'GEOCODING_ERROR').format(searched=loc_from_str)
             sendMessageFunction(chat_id, response)
 
-    if loc_to_str:
-        loc_to = search_place(loc_to_str)
+    if loc_to_future:
+        loc_to = loc_to_future.result()
         if not loc_to:
             response = output_sentences.get(LANGUAGE, 'GEOCODING_ERROR').format(searched=loc_to_str)
             sendMessageFunction(chat_id, response)
@@ -358,11 +448,10 @@ def plan_trip(chat_id, entities):
             else:
                 loc_from = location
 
-    city1, result_from = bikes.search_nearest(loc_from, 'bikes')
-    city2, result_to = bikes.search_nearest(loc_to, 'slots')
+    info_from, info_to, result_from, result_to = bikes.search_trip(loc_from, loc_to, BIKE_SPEED, WALK_SPEED)
 
-    if city1 and city2 and city1 is not city2:
-        response = output_sentences.get(LANGUAGE, 'INTERCITY_TRIP').format(source=city1, destination=city2)
+    if info_from is not None and info_to is not None and info_from.tag != info_to.tag:
+        response = output_sentences.get(LANGUAGE, 'INTERCITY_TRIP').format(source=info_from.city, destination=info_to.city)
         sendMessageFunction(chat_id, response)
         return
 
@@ -370,6 +459,35 @@ def plan_trip(chat_id, entities):
 
     recommend(chat_id, [result_from, result_to])
 
+def subscribe(chat_id):
+    """Subscribes the user to the stations around the position of the last search"""
+    search = last_searches.get(chat_id, None)
+    if not search:
+        sendMessageFunction(chat_id, output_sentences.get(LANGUAGE, 'NOTHING_TO_SUBSCRIBE'))
+        return
+
+    tag, stations = bikes.search_within(search['location'], SUBSCRIPTION_RADIUS)
+    if not stations:
+        sendMessageFunction(chat_id, output_sentences.get(LANGUAGE, 'ERROR_SEARCHING'))
+        return
+
+    subscriptions.subscribe(chat_id, tag, [(x.name, x.latitude, x.longitude) for x in stations], search['search_type'])
+    key = 'SUBSCRIBED_BIKES' if search['search_type'] == 'bikes' else 'SUBSCRIBED_SLOTS'
+    sendMessageFunction(chat_id, output_sentences.get(LANGUAGE, key).format(radius=int(SUBSCRIPTION_RADIUS), minutes=int(SUBSCRIPTION_TTL // 60)))
+
+
+def notify_subscription(subscription, station):
+    """Executed on the refresh pool when a subscription fires"""
+    if subscription.search_type == 'bikes':
+        response = output_sentences.get(LANGUAGE, 'NOTIFY_BIKES').format(count=station.bikes, station_name=station.name)
+        marker_type = 'bike'
+    else:
+        response = output_sentences.get(LANGUAGE, 'NOTIFY_SLOTS').format(count=station.free, station_name=station.name)
+        marker_type = 'slot'
+    markers = [{'type': marker_type, 'value': {'lat': station.latitude, 'lng': station.longitude, 'name': station.name}}]
+    sendMessageFunction(subscription.chat_id, response, msg_type='map', markers=markers)
+
+
 def save_context(chat_id, intent, entities):
     contexts[chat_id] = {'intent': intent, 'entities': entities}
 
@@ -389,5 +507,19 @@ def context_continue(chat_id):
 def askFeedback():
     return [{'type': 'text', 'value': '👍'}, {'type': 'text', 'value': '👎'}]
 
+def askSubscription():
+    return [{'type': 'text', 'value': SUBSCRIBE_BUTTON}]
+
+imported_places = read_places(GAZETTEER_FILE) if GAZETTEER_FILE else []
+gazetteer = Gazetteer([])
+gazetteer_key = None
+update_gazetteer()
+schedule.every(1).minutes.do(update_gazetteer)
+schedule.every(10).minutes.do(lambda: print('http stats: ' + str(http_client.stats())))
+geocoding_cache = GeocodingCache(persistence, ttl=GEOCODING_TTL, negative_ttl=GEOCODING_NEGATIVE_TTL)
+subscriptions = Subscriptions(notify_subscription, SUBSCRIPTION_TTL)
+bikes.add_change_listener(subscriptions.on_changes)
+schedule.every(1).minutes.do(subscriptions.expire)
+
 wit_token = os.environ['WIT_TOKEN_' + LANGUAGE]
 extractor = Nlu(wit_token, LANGUAGE.lower())
@@ -0,0 +1,88 @@
+"""
+Keeps track of how much each city is requested and how fast its stations
+change, to decide how often it has to be refreshed.
+"""
+import math
+import time
+import threading
+
+
+class DemandTracker(object):
+    """
+    The refresh interval of a city starts from max_interval (the max staleness)
+    and gets shorter the more the city has been queried in the last window
+    seconds, and the more its stations changed between the last refreshes.
+    A city not queried for idle_ttl seconds is idle and can be evicted.
+    """
+
+    def __init__(self, min_interval=30, max_interval=600, idle_ttl=86400, window=600, reference_change=0.02):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_ttl = idle_ttl
+        self.window = window
+        # fraction of stations changing in a minute that leaves the interval unchanged
+        self.reference_change = reference_change
+        self.lock = threading.Lock()
+        # tag -> {'last_query', 'queries', 'change_rate'}
+        self.cities = {}
+
+    def __get(self, tag):
+        return self.cities.setdefault(tag, {'last_query': 0, 'queries': 0.0, 'change_rate': None})
+
+    def __decayed_queries(self, city, now):
+        return city['queries'] * math.exp(-(now - city['last_query']) / self.window)
+
+    def record_query(self, tag, now=None):
+        now = now or time.time()
+        with self.lock:
+            city = self.__get(tag)
+            # exponentially decayed count of the queries in the last window
+            city['queries'] = self.__decayed_queries(city, now) + 1
+            city['last_query'] = now
+
+    def last_query(self, tag):
+        """When the city has been queried for the last time, or None"""
+        with self.lock:
+            city = self.cities.get(tag, None)
+            return city['last_query'] if city else None
+
+    def restore(self, tag, last_query):
+        """Sets when the city was last queried, without counting a query (after a restart)"""
+        with self.lock:
+            self.__get(tag)['last_query'] = last_query
+
+    def record_refresh(self, tag, changed_fraction, elapsed):
+        """changed_fraction of the stations changed in the elapsed seconds since the previous refresh"""
+        if elapsed <= 0:
+            return
+        rate = changed_fraction / elapsed * 60
+        with self.lock:
+            city = self.__get(tag)
+            if city['change_rate'] is None:
+                city['change_rate'] = rate
+            else:
+                city['change_rate'] = 0.7 * city['change_rate'] + 0.3 * rate
+
+    def interval(self, tag, now=None):
+        """How many seconds the data of the city can be kept before refreshing it"""
+        now = now or time.time()
+        with self.lock:
+            city = self.cities.get(tag, None)
+            if not city:
+                return self.max_interval
+            interval = self.max_interval / (1 + self.__decayed_queries(city, now))
+            if city['change_rate'] is not None:
+                # stations that change slowly are refreshed less often, and vice versa
+                factor = self.reference_change / max(city['change_rate'], 1e-6)
+                interval *= min(max(factor, 0.25), 4)
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def idle(self, now=None):
+        """The tags of the cities not queried for idle_ttl seconds"""
+        now = now or time.time()
+        with self.lock:
+            return [tag for tag, city in self.cities.items() if now - city['last_query'] > self.idle_ttl]
+
+    def forget(self, tag):
+        with self.lock:
+            self.cities.pop(tag, None)
@@ -0,0 +1,70 @@
+"""
+Runs the processing of the incoming messages on a bounded pool of threads.
+Messages from different users are processed concurrently, while the messages
+of the same user are processed one at a time in arrival order, so that the
+chat contexts keep working.
+"""
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class UserDispatcher(object):
+    """
+    Dispatches each message to the handler, serializing the messages by userId.
+    A user has an entry in self.pending only while one task for that user is
+    scheduled on the pool, so at most one worker at a time processes its messages.
+    """
+
+    def __init__(self, handler, max_workers=None):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        # userId -> deque of the messages waiting to be processed
+        self.pending = {}
+        # set by shutdown, then the tasks process all the messages of their user before ending
+        self.closed = False
+
+    def submit(self, message):
+        """Enqueues the message, returns immediately"""
+        user_id = message['userId']
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('cannot submit messages after shutdown')
+            user_queue = self.pending.get(user_id, None)
+            if user_queue is not None:
+                # a task for this user is already scheduled, it will pick this up
+                user_queue.append(message)
+                return
+            self.pending[user_id] = deque([message])
+            self.executor.submit(self.__run_one, user_id)
+
+    def __run_one(self, user_id):
+        """
+        Processes the oldest message of the user, then reschedules itself if
+        more are waiting. After shutdown it processes them all instead.
+        """
+        while True:
+            with self.lock:
+                message = self.pending[user_id].popleft()
+            try:
+                self.handler(message)
+            except Exception:
+                traceback.print_exc()
+
+            with self.lock:
+                if not self.pending[user_id]:
+                    del self.pending[user_id]
+                    return
+                if not self.closed:
+                    # go back at the end of the pool queue, so that a chatty user does not
+                    # keep a worker busy while other users are waiting
+                    self.executor.submit(self.__run_one, user_id)
+                    return
+
+    def shutdown(self, wait=True):
+        """Stops accepting messages. The ones already submitted are still processed"""
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=wait)
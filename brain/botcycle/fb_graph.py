@@ -1,4 +1,4 @@
-import requests
+from . import http_client
 
 graph_endpoint = 'https://graph.facebook.com/v2.10'
 
@@ -10,15 +10,15 @@ def __getHeader(token):
 def __get_unpaged(endpoint, params, token):
     results = []
     _params = params.copy()
-    params['limit'] = 100
+    _params['limit'] = 100
     # Facebook API uses pagination for likes, but we want them all
-    partial = requests.get(endpoint, params=_params,
-                           headers=__getHeader(token)).json()
+    partial = http_client.get('facebook', endpoint, params=_params,
+                              headers=__getHeader(token)).json()
     
     while partial['paging'].get('next', None) != None:
         results.extend(partial['data'])
-        partial = requests.get(partial['paging']['next'],
-                               headers=__getHeader(token)).json()
+        partial = http_client.get('facebook', partial['paging']['next'],
+                                  headers=__getHeader(token)).json()
 
     return results
 
@@ -32,7 +32,7 @@ def get_user_likes(token):
 
 def get_user_profile(token):
     params = {'fields': 'age_range,gender,location'}
-    return requests.get(graph_endpoint + '/me', params=params, headers=__getHeader(token)).json()
+    return http_client.get('facebook', graph_endpoint + '/me', params=params, headers=__getHeader(token)).json()
 
 
 def get_user_tagged_places(token):
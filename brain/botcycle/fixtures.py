@@ -0,0 +1,141 @@
+"""
+An offline stand-in for pybikes, to run the bikes module without network.
+FixtureFeed has the functions of the pybikes module used by bikes.py
+(get_all_data, get_data, get and PyBikesScraper), and serves recorded or
+synthetic snapshots of the stations: each update of a system replays the next
+snapshot of its city, starting again from the first after the last one.
+
+A fixture file is JSON:
+    {"cities": [{"tag": ..., "meta": {"city", "latitude", "longitude", ...},
+                 "snapshots": [{"time": ..., "stations": [[name, latitude, longitude, bikes, free], ...]}]}]}
+"""
+import json
+import time
+import threading
+
+import numpy as np
+
+# what get_all_data returns, the name of the single data file of the feed
+DATA_FILE = 'fixtures.json'
+
+
+class FixtureStation(object):
+    """Has the fields of a pybikes station that are read by the snapshots"""
+
+    def __init__(self, name, latitude, longitude, bikes, free):
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.bikes = bikes
+        self.free = free
+
+
+class FixtureSystem(object):
+
+    def __init__(self, feed, tag):
+        self.feed = feed
+        self.tag = tag
+        self.meta = feed.cities[tag]['meta']
+        self.stations = []
+
+    def update(self, scraper=None):
+        self.stations = [FixtureStation(*row) for row in self.feed.next_snapshot(self.tag)['stations']]
+
+
+class FixtureFeed(object):
+
+    def __init__(self, cities, delay=0.0):
+        # tag -> {'meta', 'snapshots'}
+        self.cities = {city['tag']: city for city in cities}
+        # seconds waited by each update, to simulate the download
+        self.delay = delay
+        self.lock = threading.Lock()
+        # tag -> position of the next snapshot to replay
+        self.positions = {}
+        self.__version__ = 'fixtures'
+        self.PyBikesScraper = FixtureScraper
+
+    @classmethod
+    def load(cls, path, delay=0.0):
+        with open(path) as f:
+            return cls(json.load(f)['cities'], delay)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'cities': list(self.cities.values())}, f)
+
+    @classmethod
+    def synthetic(cls, sizes, snapshots=10, change=0.05, spread=0.05, seed=0, delay=0.0):
+        """
+        A feed with a city for each element of sizes, with that many stations
+        scattered around a random center. Between consecutive snapshots about a
+        change fraction of the stations gets different counts.
+        """
+        rng = np.random.default_rng(seed)
+        cities = []
+        for i, size in enumerate(sizes):
+            tag = 'synthetic-{}'.format(i)
+            center = (float(rng.uniform(-60, 60)), float(rng.uniform(-180, 180)))
+            latitudes = center[0] + rng.normal(0, spread, size)
+            longitudes = center[1] + rng.normal(0, spread, size)
+            capacity = rng.integers(5, 40, size)
+            bikes = rng.integers(0, capacity + 1)
+            result = []
+            for s in range(snapshots):
+                if s:
+                    changed = rng.random(size) < change
+                    bikes = np.where(changed, rng.integers(0, capacity + 1), bikes)
+                result.append({'time': s * 60.0, 'stations': [
+                    ['{}-{}'.format(tag, j), float(latitudes[j]), float(longitudes[j]), int(bikes[j]), int(capacity[j] - bikes[j])]
+                    for j in range(size)]})
+            cities.append({'tag': tag, 'snapshots': result,
+                           'meta': {'city': 'Synthetic {}'.format(i), 'latitude': center[0], 'longitude': center[1]}})
+        return cls(cities, delay)
+
+    def next_snapshot(self, tag):
+        if self.delay:
+            time.sleep(self.delay)
+        snapshots = self.cities[tag]['snapshots']
+        with self.lock:
+            position = self.positions.get(tag, 0)
+            self.positions[tag] = (position + 1) % len(snapshots)
+        return snapshots[position]
+
+    def get_all_data(self):
+        return [DATA_FILE]
+
+    def get_data(self, schema):
+        return {'instances': [{'tag': tag, 'meta': city['meta']} for tag, city in self.cities.items()]}
+
+    def get(self, tag):
+        if tag not in self.cities:
+            raise Exception('unknown system ' + tag)
+        return FixtureSystem(self, tag)
+
+
+class FixtureScraper(object):
+    """Nothing is downloaded, the timeout is only kept for compatibility"""
+
+    def __init__(self):
+        self.requests_timeout = None
+
+
+def record(tags, path, snapshots=1, interval=60):
+    """
+    Downloads the stations of the pybikes systems with the tags, snapshots
+    times every interval seconds, and writes them in a fixture file
+    """
+    import pybikes
+
+    cities = {}
+    for s in range(snapshots):
+        if s:
+            time.sleep(interval)
+        for tag in tags:
+            bikeshare = pybikes.get(tag)
+            bikeshare.update()
+            city = cities.setdefault(tag, {'tag': tag, 'meta': bikeshare.meta, 'snapshots': []})
+            city['snapshots'].append({'time': time.time(), 'stations': [
+                [x.name, x.latitude, x.longitude, x.bikes, x.free] for x in bikeshare.stations
+                if x.latitude is not None and x.longitude is not None]})
+    FixtureFeed(list(cities.values())).save(path)
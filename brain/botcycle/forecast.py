@@ -0,0 +1,152 @@
+"""
+Forecast of the bikes and free slots of the stations some minutes ahead.
+The models are trained offline from the availability history (see
+run_forecast_training.py), and evaluated at query time with a few vectorized
+operations on the candidate stations.
+
+For each city, station and search type the model has the mean availability
+for each hour of the day (the profile). For each horizon it has the
+coefficients of a linear combination, fitted on the history with least squares:
+    predicted = a * current + b * profile[hour of arrival] + c
+"""
+import os
+import time
+import warnings
+
+import numpy as np
+
+# the horizons of the models, in minutes
+HORIZONS = np.array([5, 15, 30, 45, 60, 90], dtype=np.float64)
+SEARCH_TYPES = ('bikes', 'free')
+
+
+class CityModel(object):
+
+    def __init__(self, names, profiles, coefficients, latitudes=None, longitudes=None):
+        # row -> station name and position (NaN if unknown)
+        self.names = list(names)
+        self.lat = np.asarray(latitudes, dtype=np.float64) if latitudes is not None else np.full(len(self.names), np.nan)
+        self.lng = np.asarray(longitudes, dtype=np.float64) if longitudes is not None else np.full(len(self.names), np.nan)
+        # (name, latitude, longitude) -> row, and name -> row for the names of a single station
+        self.rows = {}
+        self.by_name = {}
+        for i, key in enumerate(zip(self.names, self.lat.tolist(), self.lng.tolist())):
+            self.rows.setdefault(key, i)
+            self.by_name[key[0]] = None if key[0] in self.by_name else i
+        # search type -> (station, hour) mean availability
+        self.profiles = profiles
+        # search type -> (horizon, 3) coefficients
+        self.coefficients = coefficients
+
+    @classmethod
+    def train(cls, city_history, tolerance=None):
+        """Fits the model on a CityHistory"""
+        profiles, coefficients = {}, {}
+        for search_type in SEARCH_TYPES:
+            values, times = city_history.values(search_type)
+            profile = city_history.hourly_mean(search_type)
+            # hours without samples use the mean of the station, then 0
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                station_mean = np.nanmean(values, axis=1) if values.shape[1] else np.zeros(len(values))
+            profile = np.where(np.isnan(profile), station_mean[:, None], profile)
+            profile = np.nan_to_num(profile)
+            profiles[search_type] = profile.astype(np.float32)
+
+            coefficients[search_type] = np.array([[1.0, 0.0, 0.0]] * len(HORIZONS))
+            if len(times) < 2:
+                continue
+            step = tolerance or float(np.median(np.diff(times)))
+            for h, minutes in enumerate(HORIZONS):
+                # pair each sample with the one nearest to minutes later
+                target_times = times + minutes * 60
+                j = np.clip(np.searchsorted(times, target_times), 0, len(times) - 1)
+                ok = (np.abs(times[j] - target_times) <= step) & (j > np.arange(len(times)))
+                if not ok.any():
+                    continue
+                i, j = np.nonzero(ok)[0], j[ok]
+                current = values[:, i]
+                future = values[:, j]
+                at_arrival = profile[:, ((times[j] // 3600) % 24).astype(np.int64)]
+                valid = ~(np.isnan(current) | np.isnan(future))
+                if valid.sum() < 10:
+                    continue
+                x = np.stack([current[valid], at_arrival[valid], np.ones(valid.sum())], axis=1)
+                coefficients[search_type][h] = np.linalg.lstsq(x, future[valid], rcond=None)[0]
+        return cls(city_history.names, profiles, coefficients, city_history.lat, city_history.lng)
+
+    def row(self, name, latitude, longitude):
+        """The row of the station, matched like snapshot.align does, -1 if unknown"""
+        i = self.rows.get((name, latitude, longitude), None)
+        if i is None:
+            i = self.by_name.get(name, None)
+        return -1 if i is None else i
+
+    def predict(self, stations, counts, search_type, minutes, now=None):
+        """
+        The predicted availability of the stations (with name, latitude and
+        longitude, and their current counts) after minutes. Stations unknown to
+        the model keep their count.
+        """
+        search_type = 'bikes' if search_type == 'bikes' else 'free'
+        now = now or time.time()
+        counts = np.asarray(counts, dtype=np.float64)
+        rows = np.array([self.row(x.name, x.latitude, x.longitude) for x in stations], dtype=np.int64)
+        known = rows >= 0
+        result = counts.copy()
+        if not known.any():
+            return result
+        h = int(np.argmin(np.abs(HORIZONS - minutes)))
+        a, b, c = self.coefficients[search_type][h]
+        hour = int((now + minutes * 60) // 3600 % 24)
+        at_arrival = self.profiles[search_type][rows[known], hour]
+        result[known] = a * counts[known] + b * at_arrival + c
+        return np.maximum(result, 0)
+
+    def save(self, file_path):
+        tmp_path = file_path + '.tmp.npz'
+        np.savez(tmp_path, names=np.array(self.names, dtype=str), lat=self.lat, lng=self.lng,
+                 profile_bikes=self.profiles['bikes'], profile_free=self.profiles['free'],
+                 coefficients_bikes=self.coefficients['bikes'], coefficients_free=self.coefficients['free'])
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(data['names'].tolist(),
+                       {'bikes': data['profile_bikes'], 'free': data['profile_free']},
+                       {'bikes': data['coefficients_bikes'], 'free': data['coefficients_free']},
+                       *((data['lat'], data['lng']) if 'lat' in data.files else (None, None)))
+
+
+class Forecaster(object):
+    """The models of all the cities, read from a directory with a file for each city"""
+
+    def __init__(self):
+        # tag -> CityModel
+        self.models = {}
+
+    def load(self, path):
+        if not os.path.isdir(path):
+            return
+        models = {}
+        for file_name in os.listdir(path):
+            if not file_name.endswith('.npz') or file_name.endswith('.tmp.npz'):
+                continue
+            try:
+                models[file_name[:-len('.npz')]] = CityModel.load(os.path.join(path, file_name))
+            except Exception as e:
+                print('discarding the forecast model {}: {}'.format(file_name, e))
+        self.models = models
+        print('loaded the forecast models of {} cities'.format(len(models)))
+
+    def predict(self, snapshot, stations, search_type, minutes):
+        """
+        The predicted bikes / free slots after minutes for the stations of the
+        snapshot. Without a model for the city it is their current value.
+        """
+        counts = [x.bikes if search_type == 'bikes' else x.free for x in stations]
+        model = self.models.get(snapshot.tag, None)
+        if model is None:
+            return np.asarray(counts, dtype=np.float64)
+        return model.predict(stations, counts, search_type, minutes)
@@ -1,5 +1,6 @@
 import os
-import requests
+
+from . import http_client
 
 FOURSQUARE_ENDPOINT = 'https://api.foursquare.com/v2/venues'
 common_params = {
@@ -17,8 +18,8 @@ def match(name, lat, lng):
         'query': name
     }
     params = {**common_params, **extra_params}
-    response = requests.get(FOURSQUARE_ENDPOINT +
-                            '/search', params=params).json()
+    response = http_client.get('foursquare', FOURSQUARE_ENDPOINT +
+                               '/search', params=params).json()
     venues = response['response']['venues']
     if venues:
         return venues[0]
@@ -33,8 +34,8 @@ def get_top_picks(lat, lng):
         'section': 'topPicks'
     }
     params = {**common_params, **extra_params}
-    response = requests.get(FOURSQUARE_ENDPOINT +
-                            '/explore', params=params).json()
+    response = http_client.get('foursquare', FOURSQUARE_ENDPOINT +
+                               '/explore', params=params).json()
 
     venues = response['response']['groups'][0]['items']
     venues = list(map(lambda venue: venue['venue'], venues))
@@ -0,0 +1,191 @@
+"""
+A local gazetteer of the places that the users often name: the bike sharing
+cities, the stations of the tracked cities and optionally an imported list of
+places. The names are normalized like the keys of the geocoding cache, and
+indexed by a prefix trie and by their trigrams for the fuzzy matching.
+
+The stations are scoped by their city: a station name is only matched when the
+user is in that city, since the same names repeat in many cities. The cities
+and the imported places are global.
+A Gazetteer is never modified after it has been built, to update it a new one
+is built and replaces the old one.
+"""
+import csv
+from collections import namedtuple
+
+import numpy as np
+
+from .geocoding import normalize_name
+
+# scope is the tag of the city of a station, None for a global place
+Place = namedtuple('Place', ['name', 'latitude', 'longitude', 'scope'])
+
+# the similarity of the trigrams (Dice coefficient) needed by a fuzzy match
+FUZZY_THRESHOLD = 0.75
+# a prefix is enough if it is this long
+MIN_PREFIX = 4
+# the min ratio between the lengths of the text and of the name for a prefix or fuzzy match
+LENGTH_RATIO = 0.85
+
+
+def trigrams(text):
+    padded = '  {} '.format(text)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similar(text, name):
+    """
+    True if text can be a misspelling or an abbreviation of name (both
+    normalized): it has a similar length, no more words and no numbers that
+    the name does not have. So an address in a street is not taken for the
+    street, as the streets are long.
+    """
+    if min(len(text), len(name)) < LENGTH_RATIO * max(len(text), len(name)):
+        return False
+    words, name_words = text.split(), name.split()
+    if len(words) > len(name_words):
+        return False
+    return all(word in name_words for word in words if any(character.isdigit() for character in word))
+
+
+class TrieNode(object):
+    __slots__ = ('children', 'ids', 'count', 'first')
+
+    def __init__(self):
+        self.children = {}
+        # the places whose name ends here
+        self.ids = []
+        # how many places have a name starting with the path of the node, and one of them
+        self.count = 0
+        self.first = None
+
+
+def read_places(path):
+    """Reads a CSV file of places, with rows name, latitude, longitude"""
+    places = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or row[0].startswith('#'):
+                continue
+            try:
+                places.append(Place(row[0], float(row[1]), float(row[2]), None))
+            except ValueError:
+                # e.g. the header
+                continue
+    return places
+
+
+class Gazetteer(object):
+
+    def __init__(self, places):
+        self.places = []
+        self.keys = []
+        self.root = TrieNode()
+        # trigram -> array of the ids of the places with it
+        postings = {}
+        for place in places:
+            key = normalize_name(place.name)
+            if not key:
+                continue
+            i = len(self.places)
+            self.places.append(place)
+            self.keys.append(key)
+            node = self.root
+            for character in key:
+                node.count += 1
+                if node.first is None:
+                    node.first = i
+                node = node.children.setdefault(character, TrieNode())
+            node.count += 1
+            if node.first is None:
+                node.first = i
+            node.ids.append(i)
+            for trigram in trigrams(key):
+                postings.setdefault(trigram, []).append(i)
+        self.postings = {trigram: np.array(ids, dtype=np.int32) for trigram, ids in postings.items()}
+        self.sizes = np.array([len(trigrams(key)) for key in self.keys], dtype=np.int32)
+
+    @classmethod
+    def build(cls, city_metas, snapshots, imported=()):
+        """From the metas of the cities (with city, latitude and longitude), the CitySnapshot of the tracked cities and the imported places"""
+        places = [Place(meta['city'], float(meta['latitude']), float(meta['longitude']), None)
+                  for meta in city_metas if meta.get('city')]
+        for info in snapshots:
+            places.extend(Place(name, float(latitude), float(longitude), info.tag)
+                          for name, latitude, longitude in zip(info.names, info.lat, info.lng))
+        places.extend(imported)
+        return cls(places)
+
+    def __len__(self):
+        return len(self.places)
+
+    def __allowed(self, i, scope):
+        return self.places[i].scope is None or self.places[i].scope == scope
+
+    def __choose(self, ids, scope):
+        """The place among ids, preferring the stations of the scope, None if the allowed ones are different places"""
+        allowed = [i for i in ids if self.__allowed(i, scope)]
+        if not allowed:
+            return None
+        scoped = [i for i in allowed if self.places[i].scope is not None]
+        candidates = scoped or allowed
+        positions = {(self.places[i].latitude, self.places[i].longitude) for i in candidates}
+        if len(positions) > 1 and not scoped:
+            return None
+        return self.places[candidates[0]]
+
+    def __find(self, key):
+        node = self.root
+        for character in key:
+            node = node.children.get(character, None)
+            if node is None:
+                return None
+        return node
+
+    def prefix(self, text, scope=None, limit=10):
+        """The places whose name starts with text, at most limit"""
+        node = self.__find(normalize_name(text))
+        result = []
+        stack = [node] if node is not None else []
+        while stack and len(result) < limit:
+            node = stack.pop()
+            result.extend(self.places[i] for i in node.ids if self.__allowed(i, scope))
+            stack.extend(node.children.values())
+        return result[:limit]
+
+    def fuzzy(self, text, scope=None):
+        """The allowed place whose name has the most similar trigrams to text, with the similarity. See similar"""
+        key = normalize_name(text)
+        query = trigrams(key)
+        postings = [self.postings[trigram] for trigram in query if trigram in self.postings]
+        if not postings:
+            return None, 0.0
+        ids, shared = np.unique(np.concatenate(postings), return_counts=True)
+        similarity = 2.0 * shared / (self.sizes[ids] + len(query))
+        for j in np.argsort(-similarity, kind='stable'):
+            if similarity[j] < FUZZY_THRESHOLD:
+                break
+            if self.__allowed(int(ids[j]), scope) and similar(key, self.keys[int(ids[j])]):
+                return self.places[int(ids[j])], float(similarity[j])
+        return None, 0.0
+
+    def lookup(self, text, scope=None):
+        """
+        The Place named by text, None if it is not known or ambiguous. scope is
+        the tag of the city of the user, its stations can be matched too.
+        Tries the exact name, then a unique prefix, then the fuzzy match. The
+        prefix and fuzzy matches must be similar to the name (see similar), the
+        other texts are left to the geocoding.
+        """
+        key = normalize_name(text)
+        if not key:
+            return None
+        node = self.__find(key)
+        if node is not None:
+            if node.ids:
+                return self.__choose(node.ids, scope)
+            if (node.count == 1 and len(key) >= MIN_PREFIX and similar(key, self.keys[node.first])
+                    and self.__allowed(node.first, scope)):
+                return self.places[node.first]
+        place, _ = self.fuzzy(key, scope)
+        return place
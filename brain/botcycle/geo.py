@@ -0,0 +1,285 @@
+"""
+Geographic helpers: great-circle distances and a spatial index to find the
+stations near a position without scanning all of them.
+"""
+import math
+import numpy as np
+
+# mean radius of the earth, in meters
+EARTH_RADIUS = 6371000.0
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters between points in decimal degrees. Works on numpy arrays"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class GridIndex(object):
+    """
+    Uniform grid over the points of a city, projected to meters with an
+    equirectangular projection centered on the city (accurate at city scale).
+    The cells are stored compressed: the point ids sorted by cell, and for each
+    cell the offset of its first point.
+    The queries visit the cells in rings of growing size around the position and
+    rank the candidates by great-circle distance.
+    """
+
+    # average number of points in a cell
+    POINTS_PER_CELL = 2
+    # the projection is not exact, the ring bound is relaxed by this factor
+    SLACK = 0.99
+    # the percentiles of the positions covered by the grid
+    BOUNDS = (1, 99)
+    # the values that describe the grid, saved with its arrays
+    PARAMS = ('lat0', 'lng0', 'cos0', 'x_min', 'y_min', 'cell_size', 'nx', 'ny')
+
+    def __init__(self, latitudes, longitudes):
+        self.lat = np.asarray(latitudes, dtype=np.float64)
+        self.lng = np.asarray(longitudes, dtype=np.float64)
+        self.size = len(self.lat)
+        if self.size:
+            self.lat0 = float(np.median(self.lat))
+            self.lng0 = float(np.median(self.lng))
+        else:
+            self.lat0 = self.lng0 = 0.0
+        self.cos0 = math.cos(math.radians(self.lat0))
+
+        x, y = self.project(self.lat, self.lng)
+        if self.size:
+            # a few stations of some feeds have wrong positions, far away: the grid
+            # covers the others, the outliers are kept in the cells at the border
+            x_lo, x_hi = np.percentile(x, self.BOUNDS)
+            y_lo, y_hi = np.percentile(y, self.BOUNDS)
+            self.x_min, self.y_min = float(x_lo), float(y_lo)
+            width, height = float(x_hi) - self.x_min, float(y_hi) - self.y_min
+        else:
+            self.x_min = self.y_min = width = height = 0.0
+        # choose the cell size to have about POINTS_PER_CELL points in each cell
+        area = max(width, 1.0) * max(height, 1.0)
+        self.cell_size = max(math.sqrt(area * self.POINTS_PER_CELL / max(self.size, 1)), 10.0)
+        self.nx = int(width // self.cell_size) + 1
+        self.ny = int(height // self.cell_size) + 1
+
+        cx, cy = self.__cell_of(x, y)
+        cells = cy * self.nx + cx
+        self.order = np.argsort(cells, kind='stable')
+        self.offsets = np.searchsorted(cells[self.order], np.arange(self.nx * self.ny + 1))
+
+    def state(self):
+        """The params and the arrays of the index, to rebuild it with from_state without computing it again"""
+        return {name: getattr(self, name) for name in self.PARAMS}, {'order': self.order, 'offsets': self.offsets}
+
+    @classmethod
+    def from_state(cls, latitudes, longitudes, params, arrays):
+        index = cls.__new__(cls)
+        index.lat = np.asarray(latitudes, dtype=np.float64)
+        index.lng = np.asarray(longitudes, dtype=np.float64)
+        index.size = len(index.lat)
+        for name in cls.PARAMS:
+            setattr(index, name, params[name])
+        index.order = arrays['order']
+        index.offsets = arrays['offsets']
+        return index
+
+    def project(self, lat, lng):
+        """From degrees to meters on the plane tangent to the center of the city"""
+        x = np.radians(np.asarray(lng, dtype=np.float64) - self.lng0) * self.cos0 * EARTH_RADIUS
+        y = np.radians(np.asarray(lat, dtype=np.float64) - self.lat0) * EARTH_RADIUS
+        return x, y
+
+    def __cell_of(self, x, y):
+        cx = np.floor((x - self.x_min) / self.cell_size).astype(np.int64)
+        cy = np.floor((y - self.y_min) / self.cell_size).astype(np.int64)
+        return np.clip(cx, 0, self.nx - 1), np.clip(cy, 0, self.ny - 1)
+
+    def __clipped(self, value, minimum, cells):
+        """The column (or row) of the coordinate value, clipped to the grid"""
+        return min(max(int(math.floor((value - minimum) / self.cell_size)), 0), cells - 1)
+
+    def __ring(self, qx, qy, r):
+        """The ids of the points in the cells at Chebyshev distance r from (qx, qy)"""
+        x_lo, x_hi = max(qx - r, 0), min(qx + r, self.nx - 1)
+        y_lo, y_hi = max(qy - r, 0), min(qy + r, self.ny - 1)
+        if x_lo > x_hi or y_lo > y_hi:
+            return None
+        slices = []
+        for cy in range(y_lo, y_hi + 1):
+            if cy == qy - r or cy == qy + r:
+                # top and bottom rows of the ring, take the whole span
+                start = cy * self.nx + x_lo
+                slices.append(self.order[self.offsets[start]:self.offsets[start + x_hi - x_lo + 1]])
+            else:
+                for cx in (qx - r, qx + r):
+                    if 0 <= cx < self.nx:
+                        cell = cy * self.nx + cx
+                        slices.append(self.order[self.offsets[cell]:self.offsets[cell + 1]])
+        return np.concatenate(slices) if slices else None
+
+    def nearest(self, lat, lng, mask=None):
+        """
+        The id of the point nearest to (lat, lng) and its distance in meters.
+        If mask (an array of booleans) is provided, only the points where it is
+        True are considered. Returns (None, None) if there is no such point.
+        """
+        ids, distances = self.k_nearest(lat, lng, 1, mask)
+        if not len(ids):
+            return None, None
+        return int(ids[0]), float(distances[0])
+
+    def k_nearest(self, lat, lng, k, mask=None):
+        """
+        The ids of the k points nearest to (lat, lng) and their distances in
+        meters, sorted by distance (fewer than k if there are not enough).
+        mask is used as in nearest.
+        """
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0)
+        if not self.size or k < 1:
+            return empty
+        x, y = self.project(lat, lng)
+        # the cell of the position, also outside of the grid
+        qx = int(math.floor((float(x) - self.x_min) / self.cell_size))
+        qy = int(math.floor((float(y) - self.y_min) / self.cell_size))
+        # start from the first ring that touches the grid
+        r = max(0, -qx, qx - self.nx + 1, -qy, qy - self.ny + 1)
+        r_max = r + max(self.nx, self.ny)
+        best, best_d = empty
+        while r <= r_max:
+            # every point outside of rings 0..r-1 is at least this far
+            if len(best) == k and best_d[-1] <= (r - 1) * self.cell_size * self.SLACK:
+                break
+            candidates = self.__ring(qx, qy, r)
+            if candidates is not None and mask is not None:
+                candidates = candidates[mask[candidates]]
+            if candidates is not None and len(candidates):
+                d = haversine(lat, lng, self.lat[candidates], self.lng[candidates])
+                if len(best):
+                    candidates, d = np.concatenate([best, candidates]), np.concatenate([best_d, d])
+                # keep only the k best so far, sorted
+                order = np.argsort(d, kind='stable')[:k]
+                best, best_d = candidates[order], d[order]
+            r += 1
+        return best, best_d
+
+    def nearest_many(self, lats, lngs, mask=None):
+        """
+        Like nearest for many positions at once: returns the array of the ids
+        (-1 where there is none) and the array of the distances (NaN where
+        there is none). The positions are grouped by the cell they fall in,
+        and each group is searched with a single distance matrix for each ring.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        ids = np.full(len(lats), -1, dtype=np.int64)
+        distances = np.full(len(lats), np.inf)
+        if not self.size or not len(lats):
+            return ids, np.full(len(lats), np.nan)
+        x, y = self.project(lats, lngs)
+        qx = np.floor((x - self.x_min) / self.cell_size).astype(np.int64)
+        qy = np.floor((y - self.y_min) / self.cell_size).astype(np.int64)
+        cells, group_of = np.unique(np.stack([qx, qy], axis=1), axis=0, return_inverse=True)
+        group_of = group_of.reshape(-1)
+        order = np.argsort(group_of, kind='stable')
+        bounds = np.searchsorted(group_of[order], np.arange(len(cells) + 1))
+        for g, (cx, cy) in enumerate(cells):
+            members = order[bounds[g]:bounds[g + 1]]
+            cx, cy = int(cx), int(cy)
+            r = max(0, -cx, cx - self.nx + 1, -cy, cy - self.ny + 1)
+            r_max = r + max(self.nx, self.ny)
+            best, best_d = ids[members], distances[members]
+            while r <= r_max:
+                if (best_d <= (r - 1) * self.cell_size * self.SLACK).all():
+                    break
+                candidates = self.__ring(cx, cy, r)
+                if candidates is not None and mask is not None:
+                    candidates = candidates[mask[candidates]]
+                if candidates is not None and len(candidates):
+                    d = haversine(lats[members][:, None], lngs[members][:, None],
+                                  self.lat[candidates][None, :], self.lng[candidates][None, :])
+                    j = np.argmin(d, axis=1)
+                    d_j = d[np.arange(len(members)), j]
+                    better = d_j < best_d
+                    best[better], best_d[better] = candidates[j[better]], d_j[better]
+                r += 1
+            ids[members], distances[members] = best, best_d
+        distances[ids < 0] = np.nan
+        return ids, distances
+
+    def within(self, lat, lng, radius, mask=None):
+        """
+        The ids of the points within radius meters from (lat, lng) and their
+        distances, sorted by distance. mask is used as in nearest.
+        """
+        if not self.size:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        x, y = self.project(lat, lng)
+        # the block of cells that contains the circle, clipped to the grid: the
+        # cells at the border also have the points outside of the grid
+        reach = radius / self.SLACK
+        x_lo, x_hi = self.__clipped(float(x) - reach, self.x_min, self.nx), self.__clipped(float(x) + reach, self.x_min, self.nx)
+        y_lo, y_hi = self.__clipped(float(y) - reach, self.y_min, self.ny), self.__clipped(float(y) + reach, self.y_min, self.ny)
+        slices = []
+        for cy in range(y_lo, y_hi + 1):
+            start = cy * self.nx + x_lo
+            slices.append(self.order[self.offsets[start]:self.offsets[start + x_hi - x_lo + 1]])
+        candidates = np.concatenate(slices)
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        d = haversine(lat, lng, self.lat[candidates], self.lng[candidates])
+        inside = d <= radius
+        candidates, d = candidates[inside], d[inside]
+        order = np.argsort(d, kind='stable')
+        return candidates[order], d[order]
+
+
+def to_unit_vectors(lat, lng):
+    """From degrees to points on the unit sphere, one row for each point"""
+    lat, lng = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)], axis=-1)
+
+
+class SphereIndex(object):
+    """
+    Index for points spread all over the world (like the cities).
+    The points are kept as a contiguous array of unit vectors, the nearest one
+    is the one with the biggest dot product with the position, so a query is a
+    single vectorized product without any trigonometry on the points.
+    """
+
+    def __init__(self, latitudes, longitudes):
+        self.size = len(latitudes)
+        self.vectors = to_unit_vectors(latitudes, longitudes).reshape(self.size, 3)
+
+    def nearest(self, lat, lng):
+        """The id of the point nearest to (lat, lng) and its distance in meters"""
+        if not self.size:
+            return None, None
+        dots = self.vectors.dot(to_unit_vectors(lat, lng))
+        best = int(np.argmax(dots))
+        return best, float(np.arccos(np.clip(dots[best], -1.0, 1.0)) * EARTH_RADIUS)
+
+    def k_nearest(self, lat, lng, k):
+        """The ids of the k points nearest to (lat, lng) and their distances in meters, sorted by distance"""
+        if not self.size:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        dots = self.vectors.dot(to_unit_vectors(lat, lng))
+        k = min(k, self.size)
+        best = np.argpartition(-dots, k - 1)[:k]
+        best = best[np.argsort(-dots[best], kind='stable')]
+        return best, np.arccos(np.clip(dots[best], -1.0, 1.0)) * EARTH_RADIUS
+
+    def nearest_many(self, lats, lngs, chunk=4096):
+        """Like nearest for many positions at once, returns the array of the ids and of the distances"""
+        queries = to_unit_vectors(lats, lngs).reshape(-1, 3)
+        ids = np.zeros(len(queries), dtype=np.int64)
+        distances = np.zeros(len(queries))
+        if not self.size:
+            return ids - 1, distances + np.nan
+        for start in range(0, len(queries), chunk):
+            dots = queries[start:start + chunk].dot(self.vectors.T)
+            best = np.argmax(dots, axis=1)
+            ids[start:start + chunk] = best
+            distances[start:start + chunk] = np.arccos(np.clip(dots[np.arange(len(best)), best], -1.0, 1.0)) * EARTH_RADIUS
+        return ids, distances
@@ -0,0 +1,84 @@
+"""
+Cache of the results of the geocoding of the place names. The first tier is
+an LRU in memory with a TTL, the second one is persistent (the geocoding
+collection of mongo, see persistence.py) and survives the restarts. The keys
+are normalized, so that the small differences in how the users write a name
+share the same entry. The names without a result are cached too, for a
+shorter time.
+"""
+import re
+import time
+import datetime
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_name(place_name):
+    """The place name case folded, without punctuation and repeated spaces"""
+    text = unicodedata.normalize('NFKC', place_name).casefold()
+    return ' '.join(re.sub(r'[^\w]+', ' ', text).split())
+
+
+def normalize(place_name, scope=None):
+    """The key of the place name: the normalized name prefixed by the scope"""
+    return '{}|{}'.format(scope or '', normalize_name(place_name))
+
+
+class GeocodingCache(object):
+
+    def __init__(self, store=None, size=10000, ttl=30 * 86400, negative_ttl=600):
+        # with get_geocoding(key) and save_geocoding(key, location), None to keep the cache in memory only
+        self.store = store
+        self.size = size
+        # seconds a result is kept, and a missing result
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # key -> (location or None, expiration time), least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Returns (found, location): location is None if the name is cached as not found"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    return True, entry[0]
+                del self.entries[key]
+
+        if self.store is None:
+            return False, None
+        try:
+            document = self.store.get_geocoding(key)
+        except Exception as e:
+            print('cannot read the geocoding cache: ' + str(e))
+            return False, None
+        if not document:
+            return False, None
+        location = document.get('location', None)
+        age = (datetime.datetime.utcnow() - document['time']).total_seconds()
+        expires = now - age + (self.ttl if location is not None else self.negative_ttl)
+        if expires <= now:
+            return False, None
+        self.__remember(key, location, expires)
+        return True, location
+
+    def put(self, key, location):
+        """Caches the location of the key, None if the name has not been found"""
+        self.__remember(key, location, time.time() + (self.ttl if location is not None else self.negative_ttl))
+        if self.store is None:
+            return
+        try:
+            self.store.save_geocoding(key, location)
+        except Exception as e:
+            print('cannot write the geocoding cache: ' + str(e))
+
+    def __remember(self, key, location, expires):
+        with self.lock:
+            self.entries[key] = (location, expires)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
@@ -0,0 +1,201 @@
+"""
+History of the availability of the stations, fed by the refreshes of the cities.
+Each city keeps its samples in ring buffers: a row for each station and a
+column for each sample, all the stations of a city share the column times.
+The values are int16, -1 where a station has no value for a sample.
+"""
+import os
+import threading
+import warnings
+
+import numpy as np
+
+from .snapshot import align
+
+MISSING = -1
+
+
+class CityHistory(object):
+
+    def __init__(self, capacity, names=None, times=None, bikes=None, free=None, head=0, count=0,
+                 latitudes=None, longitudes=None):
+        self.capacity = capacity
+        # row -> station name and position, the stations are matched like snapshot.align does.
+        # The position is NaN if unknown (the histories saved without it), then only the name is matched
+        self.names = list(names) if names is not None else []
+        self.lat = np.asarray(latitudes, dtype=np.float64) if latitudes is not None else np.full(len(self.names), np.nan)
+        self.lng = np.asarray(longitudes, dtype=np.float64) if longitudes is not None else np.full(len(self.names), np.nan)
+        # the rows of the stations of the last snapshot added, reused while its stations are shared
+        self.last_names = None
+        self.last_lat = None
+        self.last_rows = None
+        self.times = times if times is not None else np.zeros(capacity, dtype=np.float64)
+        self.bikes = bikes if bikes is not None else np.full((0, capacity), MISSING, dtype=np.int16)
+        self.free = free if free is not None else np.full((0, capacity), MISSING, dtype=np.int16)
+        # the column that will be written next, and how many columns are valid
+        self.head = head
+        self.count = count
+
+    def last_time(self):
+        if not self.count:
+            return None
+        return float(self.times[(self.head - 1) % self.capacity])
+
+    def add(self, snapshot):
+        """Appends a sample with the counts of the snapshot, overwriting the oldest one when full"""
+        if snapshot.names is self.last_names and snapshot.lat is self.last_lat:
+            rows = self.last_rows
+        else:
+            rows = self.__rows(snapshot)
+        column = self.head
+        self.bikes[:, column] = MISSING
+        self.free[:, column] = MISSING
+        self.bikes[rows, column] = np.clip(snapshot.bikes, 0, np.iinfo(np.int16).max)
+        self.free[rows, column] = np.clip(snapshot.free, 0, np.iinfo(np.int16).max)
+        self.times[column] = snapshot.time
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def __rows(self, snapshot):
+        """The row of each station of the snapshot, adding the new stations"""
+        rows = align(snapshot.names, snapshot.lat, snapshot.lng, self.names, self.lat, self.lng)
+        new = np.nonzero(rows < 0)[0]
+        if len(new):
+            rows[new] = len(self.names) + np.arange(len(new))
+            self.names.extend(snapshot.names[i] for i in new.tolist())
+            grow = np.full((len(new), self.capacity), MISSING, dtype=np.int16)
+            self.bikes = np.vstack([self.bikes, grow])
+            self.free = np.vstack([self.free, grow])
+            self.lat = np.concatenate([self.lat, np.full(len(new), np.nan)])
+            self.lng = np.concatenate([self.lng, np.full(len(new), np.nan)])
+        # the positions of the new stations, and of the ones matched by name that moved
+        self.lat[rows] = snapshot.lat
+        self.lng[rows] = snapshot.lng
+        self.last_names, self.last_lat, self.last_rows = snapshot.names, snapshot.lat, rows
+        return rows
+
+    def columns(self, start=None, end=None):
+        """The valid columns in chronological order, only the ones with start <= time < end if given"""
+        columns = (self.head - self.count + np.arange(self.count)) % self.capacity
+        if start is not None:
+            columns = columns[self.times[columns] >= start]
+        if end is not None:
+            columns = columns[self.times[columns] < end]
+        return columns
+
+    def values(self, search_type, start=None, end=None):
+        """
+        The samples in the window as a float matrix (station, sample) with NaN
+        where missing, and the times of the samples
+        """
+        columns = self.columns(start, end)
+        source = self.bikes if search_type == 'bikes' else self.free
+        values = source[:, columns].astype(np.float32)
+        values[values < 0] = np.nan
+        return values, self.times[columns]
+
+    def hourly_mean(self, search_type, start=None, end=None):
+        """Matrix (station, hour of the day UTC) of the mean bikes / free slots in the window, NaN without samples"""
+        columns = self.columns(start, end)
+        source = self.bikes if search_type == 'bikes' else self.free
+        values = source[:, columns]
+        valid = values >= 0
+        hours = ((self.times[columns] // 3600) % 24).astype(np.int64)
+        # one-hot matrix (sample, hour), the sums for all the stations are a single product
+        one_hot = np.zeros((len(columns), 24), dtype=np.float64)
+        one_hot[np.arange(len(columns)), hours] = 1
+        sums = np.where(valid, values, 0).astype(np.float64).dot(one_hot)
+        counts = valid.astype(np.float64).dot(one_hot)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    def percentiles(self, search_type, q, start=None, end=None):
+        """Matrix (station, q) of the percentiles q (0-100) in the window, NaN without samples"""
+        values, _ = self.values(search_type, start, end)
+        if not values.shape[1]:
+            return np.full((len(self.names), len(np.atleast_1d(q))), np.nan)
+        with warnings.catch_warnings():
+            # stations without samples in the window give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanpercentile(values, np.atleast_1d(q), axis=1).T
+
+
+class AvailabilityHistory(object):
+    """
+    The history of all the tracked cities. Keeps about days of samples for each
+    city, taking at most one sample every sample_interval seconds, so the
+    memory used by a city is bounded by its stations * capacity * 4 bytes.
+    """
+
+    def __init__(self, days=7, sample_interval=300):
+        self.sample_interval = sample_interval
+        self.capacity = int(days * 24 * 3600 // sample_interval)
+        self.lock = threading.Lock()
+        # tag -> CityHistory
+        self.cities = {}
+
+    def record(self, snapshot):
+        with self.lock:
+            city = self.cities.get(snapshot.tag, None)
+            if city is None:
+                city = self.cities[snapshot.tag] = CityHistory(self.capacity)
+            last = city.last_time()
+            if last is not None and snapshot.time - last < self.sample_interval:
+                return
+            city.add(snapshot)
+
+    def city(self, tag):
+        """The CityHistory of the city, or None"""
+        return self.cities.get(tag, None)
+
+    def save(self, path):
+        """Writes a checkpoint of all the cities in the directory path, one file each"""
+        os.makedirs(path, exist_ok=True)
+        # copied under the lock, written without it so that record does not wait for the disk
+        with self.lock:
+            copies = {tag: (list(city.names), city.lat.copy(), city.lng.copy(), city.times.copy(),
+                            city.bikes.copy(), city.free.copy(), city.head, city.count)
+                      for tag, city in self.cities.items()}
+        for tag, (names, lat, lng, times, bikes, free, head, count) in copies.items():
+            file_path = os.path.join(path, tag + '.npz')
+            tmp_path = file_path + '.tmp.npz'
+            np.savez(tmp_path, names=np.array(names, dtype=str), lat=lat, lng=lng, times=times,
+                     bikes=bikes, free=free, head=head, count=count)
+            os.replace(tmp_path, file_path)
+
+    def load(self, path):
+        """Loads the checkpoint written by save, if there is one"""
+        if not os.path.isdir(path):
+            return
+        for file_name in os.listdir(path):
+            if not file_name.endswith('.npz') or file_name.endswith('.tmp.npz'):
+                continue
+            tag = file_name[:-len('.npz')]
+            try:
+                with np.load(os.path.join(path, file_name)) as data:
+                    # the checkpoints of the older versions have no positions
+                    positions = (data['lat'], data['lng']) if 'lat' in data.files else (None, None)
+                    city = CityHistory(len(data['times']), data['names'].tolist(), data['times'],
+                                       data['bikes'], data['free'], int(data['head']), int(data['count']), *positions)
+            except Exception as e:
+                print('discarding the history of {}: {}'.format(tag, e))
+                continue
+            if city.capacity != self.capacity:
+                # the configuration changed, keep the samples in chronological order
+                city = self.__resized(city)
+            with self.lock:
+                self.cities[tag] = city
+        print('loaded the history of {} cities'.format(len(self.cities)))
+
+    def __resized(self, city):
+        columns = city.columns()[-self.capacity:]
+        count = len(columns)
+        resized = CityHistory(self.capacity, city.names, latitudes=city.lat, longitudes=city.lng)
+        resized.bikes = np.full((len(city.names), self.capacity), MISSING, dtype=np.int16)
+        resized.free = np.full((len(city.names), self.capacity), MISSING, dtype=np.int16)
+        resized.bikes[:, :count] = city.bikes[:, columns]
+        resized.free[:, :count] = city.free[:, columns]
+        resized.times[:count] = city.times[columns]
+        resized.head = count % self.capacity
+        resized.count = count
+        return resized
@@ -0,0 +1,81 @@
+"""
+The HTTP client shared by all the calls to the external APIs. A single session
+keeps a pool of keep-alive connections for each host, so the TCP and TLS
+handshakes are not repeated at each call. Each endpoint has its own timeouts
+and retries, and counters of the latency and the errors.
+"""
+import os
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# connections kept open for each host
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+
+# endpoint -> (connect timeout, read timeout) in seconds, and how many times a failed request is retried
+ENDPOINTS = {
+    'geocoding': {'timeout': (3, 5), 'retries': 2},
+    'wit': {'timeout': (3, 10), 'retries': 2},
+    'foursquare': {'timeout': (3, 10), 'retries': 1},
+    'facebook': {'timeout': (3, 20), 'retries': 2},
+}
+DEFAULT_ENDPOINT = {'timeout': (3, 10), 'retries': 1}
+# the responses with these status codes are retried
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# seconds before the first retry, doubled at each one, with random jitter
+BACKOFF = 0.2
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+stats_lock = threading.Lock()
+# endpoint -> {'requests', 'errors', 'retries', 'latency', 'max_latency'}, latency is the total in seconds.
+# They only count the calls of this process: the clients must not call from child processes (see nlu.Nlu)
+counters = {}
+
+
+def __count(endpoint, latency, error, retries):
+    with stats_lock:
+        counter = counters.setdefault(endpoint, {'requests': 0, 'errors': 0, 'retries': 0, 'latency': 0.0, 'max_latency': 0.0})
+        counter['requests'] += 1
+        counter['errors'] += 1 if error else 0
+        counter['retries'] += retries
+        counter['latency'] += latency
+        counter['max_latency'] = max(counter['max_latency'], latency)
+
+
+def get(endpoint, url, params=None, headers=None):
+    """
+    GET on the url with the timeouts and the retries of the endpoint (a key of
+    ENDPOINTS). Connection errors, timeouts and the RETRY_STATUSES are retried,
+    the last error is raised or the last response returned.
+    """
+    config = ENDPOINTS.get(endpoint, DEFAULT_ENDPOINT)
+    started = time.time()
+    attempt = 0
+    while True:
+        try:
+            response = session.get(url, params=params, headers=headers, timeout=config['timeout'])
+            if response.status_code not in RETRY_STATUSES or attempt >= config['retries']:
+                __count(endpoint, time.time() - started, response.status_code >= 400, attempt)
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= config['retries']:
+                __count(endpoint, time.time() - started, True, attempt)
+                raise
+        attempt += 1
+        time.sleep(BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+
+def stats():
+    """A copy of the counters of each endpoint, with the mean latency"""
+    with stats_lock:
+        result = {endpoint: dict(counter) for endpoint, counter in counters.items()}
+    for counter in result.values():
+        counter['mean_latency'] = counter['latency'] / counter['requests']
+    return result
@@ -3,17 +3,14 @@ This module handles NLU requests.
 Contains a wrapper for wit.ai and a wrapper for the neural network jointSLU
 """
 import os
-from multiprocessing.pool import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from .wit import WitWrapper
 from .. import persistence
 
 
-def apply_async_wrapper(nlu, sentence):
-    """
-    A static wrapper for calling a class method in another process 
-    """
-    return nlu.process(sentence)
+# the wit.ai calls in progress at the same time, one for each worker of the dispatcher
+WIT_WORKERS = int(os.environ.get('MAX_WORKERS', 8))
 
 
 class Nlu(object):
@@ -32,7 +29,8 @@ class Nlu(object):
             if self.type == 'both':
                 self.wit = WitWrapper(token)
                 self.local = NeuralNetWrapper(language, 'wit_{}'.format(language))
-                self.pool = Pool(processes=1)
+                # a thread for each message processed at the same time, so a slow call only delays its own message
+                self.pool = ThreadPoolExecutor(max_workers=WIT_WORKERS)
             else:
                 self.real = NeuralNetWrapper(language, 'wit_{}'.format(language))
 
@@ -43,9 +41,9 @@ class Nlu(object):
         #print('nlu called')
         if self.type == 'both':
             # issue both, in separate threads to wait only max(t1,t2) instead of t1+t2
-            async_result = self.pool.apply_async(apply_async_wrapper, (self.wit, sentence))
+            wit_future = self.pool.submit(self.wit.process, sentence)
             nn_result = self.local.process(sentence)
-            wit_result = async_result.get()
+            wit_result = wit_future.result()
             # return only local processing, wit processing is done to keep the request on wit.ai
             result = nn_result
         else:
@@ -1,4 +1,4 @@
-import requests
+from .. import http_client
 
 class WitWrapper:
     def __init__(self, token):
@@ -8,7 +8,7 @@ class WitWrapper:
     def process(self, sentence):
         # with verbose queries, also returns start and end indexes of entities
         params = {'q':sentence, 'verbose': True, 'v': '20170920'}
-        response = requests.get("https://api.wit.ai/message", params = params, headers = self.headers).json()
+        response = http_client.get('wit', "https://api.wit.ai/message", params = params, headers = self.headers).json()
 
         all_entities = response.get('entities', None)
         if all_entities is None:
@@ -0,0 +1,74 @@
+"""
+The outgoing messages, waiting to be sent to botkit.
+The worker threads put the messages, a coroutine on the event loop writes them
+on the websocket.
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+
+import websockets
+
+
+class Outbox(object):
+    """
+    A bounded FIFO of outgoing messages. A message is removed only after it has
+    been sent, so if the connection drops it stays at the head and is the first
+    one to be sent after reconnecting.
+    If a spool is provided, the messages are also journaled on disk and the
+    ones left unsent by the previous run are put at the head.
+    """
+
+    def __init__(self, max_size=1000, spool=None):
+        self.max_size = max_size
+        self.spool = spool
+        # (seq, msg), seq is the position in the spool (None without spool)
+        self.messages = deque()
+        if spool:
+            self.messages.extend(spool.replay())
+        # producers wait on this when the outbox is full (the websocket is slow)
+        self.not_full = threading.Condition()
+        # set when there is something new for the writer
+        self.wakeup = asyncio.Event()
+        # the event loop of the writer, known once it has been started
+        self.loop = None
+
+    def put(self, msg):
+        """
+        Called by the worker threads. Blocks while the outbox is full.
+        Must not be called from the event loop, that would block the writer.
+        """
+        with self.not_full:
+            while len(self.messages) >= self.max_size:
+                self.not_full.wait()
+            # inside the lock, so that the order in the spool is the order of sending
+            seq = self.spool.append(msg) if self.spool else None
+            self.messages.append((seq, msg))
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def send_all(self, websocket):
+        """
+        The writer coroutine. At each wakeup it sends everything that has been
+        queued in the meantime, until the connection is closed.
+        """
+        self.loop = asyncio.get_event_loop()
+        try:
+            while True:
+                self.wakeup.clear()
+                while self.messages:
+                    seq, msg = self.messages[0]
+                    print(msg)
+                    # if the socket is slow this waits for the buffer to drain,
+                    # and the producers will wait on a full outbox
+                    await websocket.send(json.dumps(msg))
+                    with self.not_full:
+                        self.messages.popleft()
+                        self.not_full.notify()
+                    if seq:
+                        self.spool.ack(seq)
+                await self.wakeup.wait()
+        except websockets.exceptions.ConnectionClosed as e:
+            # the unsent message is still at the head, the receiving side will reconnect
+            print('writer stopped: ' + str(e))
@@ -25,7 +25,12 @@ sentences = {
         "INTERCITY_TRIP": "Your trip starts at {source} and ends at {destination}. You cannot take a bike from one city and go to another one!",
         "REQUIRED_POSITION": "I didn't manage to extract a position from your sentence",
         "END_DISCUSSION": "Bye!",
-        "THANK": "Thanks for the feedback!"
+        "THANK": "Thanks for the feedback!",
+        "NOTHING_TO_SUBSCRIBE": "Search for bikes or slots first, then I can tell you when they become available",
+        "SUBSCRIBED_BIKES": "Ok, in the next {minutes} minutes I will tell you when a bike becomes available within {radius} meters",
+        "SUBSCRIBED_SLOTS": "Ok, in the next {minutes} minutes I will tell you when a slot frees up within {radius} meters",
+        "NOTIFY_BIKES": "Now there are {count} free bikes at station {station_name}",
+        "NOTIFY_SLOTS": "Now there are {count} free slots at station {station_name}"
     },
     "IT": {
         "THANK_LOGGED_IN": "Grazie per il contributo! Ogni persona che effettua il login mi aiuta a fornire risultati migliori a tutti!",
@@ -52,7 +57,12 @@ sentences = {
         "INTERCITY_TRIP": "Il tuo viaggio inizia a {source} e finisce a {destination}. Non puoi prendere una bici in una città e portarla in un'altra!",
         "REQUIRED_POSITION": "Non sono riuscito ad estrarre una posizione dalla tua frase",
         "END_DISCUSSION": "Ciao!",
-        "THANK": "Grazie per il feedback!"
+        "THANK": "Grazie per il feedback!",
+        "NOTHING_TO_SUBSCRIBE": "Prima cerca bici o parcheggi, poi posso dirti quando diventano disponibili",
+        "SUBSCRIBED_BIKES": "Ok, nei prossimi {minutes} minuti ti dirò quando una bici sarà disponibile entro {radius} metri",
+        "SUBSCRIBED_SLOTS": "Ok, nei prossimi {minutes} minuti ti dirò quando un parcheggio si libererà entro {radius} metri",
+        "NOTIFY_BIKES": "Ora ci sono {count} bici libere alla stazione {station_name}",
+        "NOTIFY_SLOTS": "Ora ci sono {count} parcheggi liberi alla stazione {station_name}"
     }
 }
 
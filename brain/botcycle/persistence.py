@@ -17,6 +17,8 @@ facebook_users = db['facebook_users']
 
 nlu_history = db['nlu_history']
 
+geocoding = db['geocoding']
+
 
 def is_first_msg(chat_id):
     user = users.find_one({'_id': chat_id})
@@ -67,4 +69,13 @@ def get_facebook_user(facebook_id):
     return facebook_users.find_one({'_id': facebook_id})
 
 def get_facebook_users():
-    return facebook_users.find({})
\ No newline at end of file
+    return facebook_users.find({})
+
+def get_geocoding(key):
+    """the cached geocoding of the normalized place name, with its time"""
+    return geocoding.find_one({'_id': key})
+
+def save_geocoding(key, location):
+    """location is None if the place has not been found"""
+    time = datetime.datetime.utcnow()
+    geocoding.update_one({'_id': key}, {"$set": {'location': location, 'time': time}}, upsert=True)
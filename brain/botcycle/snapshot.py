@@ -0,0 +1,239 @@
+"""
+The state of the stations of a city, stored as a struct of arrays: the
+position and availability of station i are at position i of each array, and
+its name is names[i]. The queries are vectorized over the arrays.
+"""
+import os
+import json
+import struct
+from collections import namedtuple, Counter
+
+import numpy as np
+
+from .geo import GridIndex
+
+# the arrays in the files are aligned to this many bytes
+ALIGNMENT = 64
+
+
+def write_arrays(path, header, arrays):
+    """
+    Writes the arrays in a single file that can be memory-mapped by read_arrays:
+    the length of the JSON header, the header, then each array aligned.
+    The file is replaced atomically.
+    """
+    header = dict(header, arrays={})
+    position = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': position}
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    encoded = json.dumps(header).encode('utf-8')
+    start = -(-(8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_arrays(path):
+    """Reads a file written by write_arrays, returns the header and the arrays memory-mapped (read only)"""
+    with open(path, 'rb') as f:
+        length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length).decode('utf-8'))
+    start = -(-(8 + length) // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    for name, spec in header.pop('arrays').items():
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=spec['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=spec['dtype'], mode='r', offset=start + spec['offset'], shape=shape)
+    return header, arrays
+
+
+def align(names, latitudes, longitudes, old_names, old_latitudes, old_longitudes):
+    """
+    For each station (name and position), the position of the same station in
+    the old ones, -1 for a new one. The stations are matched by name and
+    position, and only by name if it is not shared by more stations, since some
+    feeds repeat the names. Each old station is matched at most once.
+    """
+    by_position = {}
+    by_name = {}
+    for j, key in enumerate(zip(old_names, np.asarray(old_latitudes).tolist(), np.asarray(old_longitudes).tolist())):
+        by_position.setdefault(key, j)
+        # None for the names used by more stations
+        by_name[key[0]] = None if key[0] in by_name else j
+    # the names repeated in the new stations too are matched only with the position
+    repeated = {name for name, count in Counter(names).items() if count > 1}
+    old = np.full(len(names), -1, dtype=np.int64)
+    used = set()
+    for i, key in enumerate(zip(names, np.asarray(latitudes).tolist(), np.asarray(longitudes).tolist())):
+        j = by_position.get(key, None)
+        if j is None or j in used:
+            j = by_name.get(key[0], None) if key[0] not in repeated else None
+        if j is not None and j not in used:
+            old[i] = j
+            used.add(j)
+    return old
+
+
+# what the queries return for a single station, it has the same fields used from
+# the pybikes stations, plus the id in the snapshot and the distance from the position
+Station = namedtuple('Station', ['id', 'name', 'latitude', 'longitude', 'bikes', 'free', 'distance'])
+
+# a station whose counts changed between two snapshots: id and name in the new
+# one, and the counts before (None for a new station) and after
+Change = namedtuple('Change', ['id', 'name', 'bikes_before', 'bikes', 'free_before', 'free'])
+
+
+class CitySnapshot(object):
+    """
+    A snapshot is never modified after it has been built: the arrays are read
+    only, and a refresh builds a new snapshot with a greater version. So it can
+    be read by any thread without locks.
+    """
+
+    def __init__(self, tag, city, time, names, latitudes, longitudes, bikes, free, index=None, version=0):
+        self.tag = tag
+        self.city = city
+        # when the data has been downloaded
+        self.time = time
+        # increasing with each snapshot published, for the invalidation of what is computed from it
+        self.version = version
+        # id -> name
+        self.names = tuple(names)
+        self.lat = np.asarray(latitudes, dtype=np.float64)
+        self.lng = np.asarray(longitudes, dtype=np.float64)
+        # an unknown count is stored as 0
+        self.bikes = np.asarray(bikes, dtype=np.int32)
+        self.free = np.asarray(free, dtype=np.int32)
+        # the index only depends on the positions
+        self.index = index or GridIndex(self.lat, self.lng)
+        for array in (self.lat, self.lng, self.bikes, self.free, self.index.order, self.index.offsets):
+            array.setflags(write=False)
+
+    @classmethod
+    def from_stations(cls, tag, city, time, stations, version=0, previous=None):
+        """
+        Builds the snapshot from the pybikes stations. If the stations are the
+        same of the previous snapshot of the city, in the same positions, only
+        the counts are new: the names, the index and the unchanged arrays are
+        shared with it.
+        """
+        # the stations without a position cannot be searched
+        stations = [x for x in stations if x.latitude is not None and x.longitude is not None]
+        names = tuple(x.name for x in stations)
+        latitudes = np.array([x.latitude for x in stations], dtype=np.float64)
+        longitudes = np.array([x.longitude for x in stations], dtype=np.float64)
+        bikes = np.array([x.bikes or 0 for x in stations], dtype=np.int32)
+        free = np.array([x.free or 0 for x in stations], dtype=np.int32)
+        if previous is None or previous.names != names or not (
+                np.array_equal(previous.lat, latitudes) and np.array_equal(previous.lng, longitudes)):
+            return cls(tag, city, time, names, latitudes, longitudes, bikes, free, version=version)
+
+        if np.array_equal(previous.bikes, bikes):
+            bikes = previous.bikes
+        if np.array_equal(previous.free, free):
+            free = previous.free
+        return cls(tag, city, time, previous.names, previous.lat, previous.lng, bikes, free,
+                   previous.index, version)
+
+    def save(self, path):
+        """Writes the snapshot and its index in a single file"""
+        params, index_arrays = self.index.state()
+        header = {'tag': self.tag, 'city': self.city, 'time': self.time, 'names': list(self.names), 'index': params}
+        arrays = {'lat': self.lat, 'lng': self.lng, 'bikes': self.bikes, 'free': self.free}
+        arrays.update(index_arrays)
+        write_arrays(path, header, arrays)
+
+    @classmethod
+    def load(cls, path, version=0):
+        """Reads a snapshot written by save. The arrays are memory-mapped, not read in memory"""
+        header, arrays = read_arrays(path)
+        index = GridIndex.from_state(arrays['lat'], arrays['lng'], header['index'],
+                                     {'order': arrays['order'], 'offsets': arrays['offsets']})
+        return cls(header['tag'], header['city'], header['time'], header['names'],
+                   arrays['lat'], arrays['lng'], arrays['bikes'], arrays['free'], index, version)
+
+    def __len__(self):
+        return len(self.names)
+
+    def counts(self, search_type):
+        """The array of bikes if search_type is 'bikes', otherwise of free slots"""
+        return self.bikes if search_type == 'bikes' else self.free
+
+    def with_at_least(self, search_type, min_count=1):
+        """Mask of the stations with at least min_count bikes / free slots"""
+        return self.counts(search_type) >= min_count
+
+    def station(self, i, distance=None):
+        return Station(i, self.names[i], float(self.lat[i]), float(self.lng[i]),
+                       int(self.bikes[i]), int(self.free[i]), distance)
+
+    def nearest(self, position, search_type, min_count=1):
+        """The nearest station with at least min_count bikes / free slots, or None"""
+        best, distance = self.index.nearest(position['latitude'], position['longitude'],
+                                            self.with_at_least(search_type, min_count))
+        if best is None:
+            return None
+        return self.station(best, distance)
+
+    def k_nearest(self, position, search_type, k, min_count=1):
+        """The k nearest stations with at least min_count bikes / free slots, sorted by distance"""
+        ids, distances = self.index.k_nearest(position['latitude'], position['longitude'], k,
+                                              self.with_at_least(search_type, min_count))
+        return [self.station(int(i), float(d)) for i, d in zip(ids, distances)]
+
+    def within(self, position, radius, search_type=None, min_count=1):
+        """The stations within radius meters, sorted by distance. Filtered on availability if search_type is given"""
+        mask = self.with_at_least(search_type, min_count) if search_type else None
+        ids, distances = self.index.within(position['latitude'], position['longitude'], radius, mask)
+        return [self.station(int(i), float(d)) for i, d in zip(ids, distances)]
+
+    def aligned(self, previous):
+        """For each station, its id in the previous snapshot, -1 for a new one. See align"""
+        if previous.names is self.names or previous.names == self.names:
+            return np.arange(len(self.names), dtype=np.int64)
+        return align(self.names, self.lat, self.lng, previous.names, previous.lat, previous.lng)
+
+    def changed(self, previous, old=None):
+        """
+        Mask of the stations whose bikes or free slots are different from the
+        previous snapshot. old is the result of aligned(previous) if already computed.
+        """
+        if previous.names is self.names and previous.bikes is self.bikes and previous.free is self.free:
+            return np.zeros(len(self.names), dtype=bool)
+        if previous.names == self.names:
+            return (previous.bikes != self.bikes) | (previous.free != self.free)
+        # stations added or removed: align the previous counts, the new ones are changed
+        if old is None:
+            old = self.aligned(previous)
+        known = old >= 0
+        result = np.ones(len(self.names), dtype=bool)
+        result[known] = (previous.bikes[old[known]] != self.bikes[known]) | (previous.free[old[known]] != self.free[known])
+        return result
+
+    def changes(self, previous, changed=None):
+        """
+        The list of the Change of the stations whose counts are different from
+        the previous snapshot, the new stations included. changed is the mask
+        from changed(previous) if already computed.
+        """
+        old = self.aligned(previous)
+        if changed is None:
+            changed = self.changed(previous, old)
+        result = []
+        for i in np.nonzero(changed)[0].tolist():
+            j = int(old[i])
+            if j < 0:
+                result.append(Change(i, self.names[i], None, int(self.bikes[i]), None, int(self.free[i])))
+            else:
+                result.append(Change(i, self.names[i], int(previous.bikes[j]), int(self.bikes[i]),
+                                     int(previous.free[j]), int(self.free[i])))
+        return result
@@ -0,0 +1,145 @@
+"""
+Append-only journal of the outgoing messages, so that the replies that were
+not yet sent survive a crash or a restart of the container.
+Each line of the file is a JSON record, either {"seq": n, "msg": {...}} for a
+queued message or {"ack": n} when all the messages up to n have been sent.
+The writes are done by a background thread in groups, with a single fsync
+for each group, so queueing a message never waits for the disk.
+"""
+import os
+import json
+import time
+import threading
+import traceback
+from collections import deque
+
+
+class Spool(object):
+
+    def __init__(self, path, flush_interval=0.05, compact_size=1024 * 1024):
+        self.path = path
+        # max time a queued message waits before being written to disk
+        self.flush_interval = flush_interval
+        # when the file grows over this size it is rewritten with only the unsent messages
+        self.compact_size = compact_size
+        self.lock = threading.Condition()
+        # serializes the writes on the file
+        self.io_lock = threading.Lock()
+        # lines waiting to be written by the flusher
+        self.buffer = []
+        # (seq, line) of the messages not acknowledged yet
+        self.unacked = deque()
+        self.last_seq = 0
+        self.last_ack = 0
+        self.ack_written = True
+        self.pending = self.__load()
+        # rewritten with only the unsent messages, without the partial last line of a crash
+        # that would otherwise be joined to the first record appended
+        self.file = None
+        self.__rewrite([line for _, line in self.unacked])
+        # approximate size of the file, to decide when to compact it
+        self.size = os.path.getsize(self.path)
+        flusher = threading.Thread(target=self.__flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def __load(self):
+        """Reads the journal left by the previous run, returns the (seq, msg) not sent"""
+        messages = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a partial line written while crashing
+                    print('spool: skipping a corrupted record')
+                    continue
+                if 'ack' in record:
+                    self.last_ack = max(self.last_ack, record['ack'])
+                else:
+                    messages[record['seq']] = record['msg']
+                    self.last_seq = max(self.last_seq, record['seq'])
+        pending = sorted((seq, msg) for seq, msg in messages.items() if seq > self.last_ack)
+        for seq, msg in pending:
+            self.unacked.append((seq, json.dumps({'seq': seq, 'msg': msg}) + '\n'))
+        print('spool: {} messages to be sent from the previous run'.format(len(pending)))
+        return pending
+
+    def replay(self):
+        """The (seq, msg) that were not delivered by the previous run, in order"""
+        pending, self.pending = self.pending, []
+        return pending
+
+    def append(self, msg):
+        """Journals a message, returns its sequence number. Does not wait for the disk"""
+        line_msg = {'msg': msg}
+        with self.lock:
+            self.last_seq += 1
+            line_msg['seq'] = self.last_seq
+            line = json.dumps(line_msg) + '\n'
+            self.unacked.append((self.last_seq, line))
+            self.buffer.append(line)
+            self.lock.notify()
+            return self.last_seq
+
+    def ack(self, seq):
+        """All the messages up to seq have been delivered"""
+        with self.lock:
+            self.last_ack = max(self.last_ack, seq)
+            while self.unacked and self.unacked[0][0] <= seq:
+                self.unacked.popleft()
+            # a single ack record is written for each group
+            self.ack_written = False
+            self.lock.notify()
+
+    def __flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.buffer and self.ack_written:
+                    self.lock.wait()
+            # let the group grow, then write it with one fsync
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def flush(self):
+        """Writes the buffered records. The disk I/O is done without holding self.lock"""
+        with self.io_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+                if not self.ack_written:
+                    lines.append(json.dumps({'ack': self.last_ack}) + '\n')
+                    self.ack_written = True
+                # everything has been delivered, the journal can be emptied
+                empty = not self.unacked
+                if not empty and self.size > self.compact_size:
+                    compact_lines = [line for _, line in self.unacked]
+                else:
+                    compact_lines = None
+            if empty:
+                self.file.truncate(0)
+                self.size = 0
+            elif compact_lines is not None:
+                self.__rewrite(compact_lines)
+            else:
+                self.file.writelines(lines)
+                self.size += sum(len(line) for line in lines)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def __rewrite(self, lines):
+        """Replaces the journal with only the provided lines (the unsent messages)"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as tmp:
+            tmp.writelines(lines)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, self.path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'a')
+        self.size = sum(len(line) for line in lines)
@@ -0,0 +1,102 @@
+"""
+Subscriptions of the users to the availability of some stations: a user is
+notified once, when one of the stations goes from less than min_count to at
+least min_count bikes / free slots. The subscriptions are indexed by city and
+station name and position (some feeds repeat the names), so a refresh only
+looks at the subscriptions of the stations that changed (see
+bikes.add_change_listener).
+"""
+import time
+import itertools
+import threading
+from collections import namedtuple
+
+# stations is the tuple of the (name, latitude, longitude) of the stations in the city tag
+Subscription = namedtuple('Subscription', ['id', 'chat_id', 'tag', 'stations', 'search_type', 'min_count', 'expires'])
+
+
+class Subscriptions(object):
+
+    def __init__(self, notify, ttl=3600):
+        # notify(subscription, station) is called when a subscription fires
+        self.notify = notify
+        # seconds after which a subscription that did not fire is dropped
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # id -> Subscription
+        self.subscriptions = {}
+        # (tag, station name, latitude, longitude) -> set of the ids of the subscriptions to it
+        self.by_station = {}
+        # (chat_id, search_type) -> id, a user has one subscription for each search type
+        self.by_chat = {}
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def subscribe(self, chat_id, tag, stations, search_type, min_count=1, now=None):
+        """Subscribes the user to the stations (name, latitude, longitude) of the city, in place of the previous subscription of the same type"""
+        search_type = 'bikes' if search_type == 'bikes' else 'free'
+        now = now or time.time()
+        stations = tuple((name, float(latitude), float(longitude)) for name, latitude, longitude in stations)
+        subscription = Subscription(next(self.ids), chat_id, tag, stations, search_type, min_count, now + self.ttl)
+        with self.lock:
+            self.__remove(self.by_chat.get((chat_id, search_type), None))
+            self.subscriptions[subscription.id] = subscription
+            self.by_chat[(chat_id, search_type)] = subscription.id
+            for station in subscription.stations:
+                self.by_station.setdefault((tag,) + station, set()).add(subscription.id)
+        return subscription
+
+    def unsubscribe(self, chat_id, search_type=None):
+        """Removes the subscriptions of the user, only the one of search_type if given"""
+        with self.lock:
+            for key in [key for key in self.by_chat if key[0] == chat_id and search_type in (None, key[1])]:
+                self.__remove(self.by_chat[key])
+
+    def __remove(self, subscription_id):
+        subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return
+        self.by_chat.pop((subscription.chat_id, subscription.search_type), None)
+        for station in subscription.stations:
+            key = (subscription.tag,) + station
+            ids = self.by_station.get(key, None)
+            if ids is not None:
+                ids.discard(subscription_id)
+                if not ids:
+                    del self.by_station[key]
+
+    def on_changes(self, info, changes):
+        """Fires the subscriptions to the changed stations of the snapshot info, see bikes.add_change_listener"""
+        now = time.time()
+        fired = []
+        with self.lock:
+            for change in changes:
+                ids = self.by_station.get((info.tag, change.name, float(info.lat[change.id]), float(info.lng[change.id])), None)
+                if not ids:
+                    continue
+                for subscription_id in list(ids):
+                    subscription = self.subscriptions[subscription_id]
+                    if subscription.expires < now:
+                        self.__remove(subscription_id)
+                        continue
+                    if subscription.search_type == 'bikes':
+                        before, after = change.bikes_before, change.bikes
+                    else:
+                        before, after = change.free_before, change.free
+                    if after >= subscription.min_count and (before is None or before < subscription.min_count):
+                        self.__remove(subscription_id)
+                        fired.append((subscription, change.id))
+        for subscription, station_id in fired:
+            try:
+                self.notify(subscription, info.station(station_id))
+            except Exception as e:
+                print('cannot notify the subscription of {}: {}'.format(subscription.chat_id, e))
+
+    def expire(self, now=None):
+        """Drops the subscriptions older than ttl"""
+        now = now or time.time()
+        with self.lock:
+            for subscription_id in [key for key, value in self.subscriptions.items() if value.expires < now]:
+                self.__remove(subscription_id)
@@ -1,23 +1,33 @@
 import os
 import asyncio
 import json
-from queue import Queue
 import traceback
 import threading
 import schedule
 import time
 import websockets
-from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv, find_dotenv
 
 # load environment from file if exists
 load_dotenv(find_dotenv())
 
 from botcycle import botcycle, persistence
+from botcycle.dispatcher import UserDispatcher
+from botcycle.outbox import Outbox
+from botcycle.spool import Spool
 
 LANGUAGE = os.environ.get('BOT_LANGUAGE', 'EN')
+WEBSOCKET_PATH = os.environ.get('WEBSOCKET_PATH', 'main')
+# how many messages (of different users) can be processed at the same time
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 8))
+# when this many replies are waiting for the websocket, the workers wait
+OUTBOX_SIZE = int(os.environ.get('OUTBOX_SIZE', 1000))
+# the journal of the replies not yet sent, set it empty to disable it.
+# Each bot has its own, the bots of the languages share the working directory
+OUTBOX_SPOOL = os.environ.get('OUTBOX_SPOOL', 'outbox.{}.{}.spool'.format(LANGUAGE, WEBSOCKET_PATH))
 
-outgoing_messages = Queue()
+spool = Spool(OUTBOX_SPOOL) if OUTBOX_SPOOL else None
+outgoing_messages = Outbox(max_size=OUTBOX_SIZE, spool=spool)
 
 
 def log_msg(message):
@@ -35,26 +45,6 @@ async def get_message(ws):
     return json.loads(message)
 
 
-def send_messages(websocket):
-    """this is executed by a dedicated thread. Gets messages from the outgoing_messages queue and sends them on the websocket"""
-    # set the event loop because this is another thread
-    asyncio.set_event_loop(loop)
-    try:
-        while True:
-            msg = outgoing_messages.get()
-            print(msg)
-            # run the async function in synchronous context
-            future = asyncio.run_coroutine_threadsafe(
-                websocket.send(json.dumps(msg)), loop)
-            future.result()
-    except websockets.exceptions.ConnectionClosed as e:
-        # this exception occurred because the connection was closed
-        # put back the message in the queue
-        # TODO find the way to put on the first place, without using deque that
-        # does not block
-        outgoing_messages.put(msg)
-
-
 def queue_message(user_id, text, msg_type='text', buttons=None, markers=None):
     msg = {'userId': user_id, 'text': text,
            'type': msg_type, 'buttons': buttons, 'markers': markers}
@@ -63,22 +53,30 @@ def queue_message(user_id, text, msg_type='text', buttons=None, markers=None):
     outgoing_messages.put(msg)
 
 
+def handle_message(message):
+    """this is executed by the worker threads of the dispatcher"""
+    log_msg(message)
+    botcycle.process(message, queue_message)
+
+
+dispatcher = UserDispatcher(handle_message, max_workers=MAX_WORKERS)
+
+
 async def main():
     while True:
         try:
             async with websockets.connect(websocket_location) as websocket:
                 print('connected to botkit')
-                sender_thread = threading.Thread(
-                    target=send_messages, args=[websocket])
-                sender_thread.daemon = True
-                sender_thread.start()
-                with ThreadPoolExecutor() as executor:
+                # the writer runs on this event loop, next to the receiving loop
+                sender = asyncio.ensure_future(
+                    outgoing_messages.send_all(websocket))
+                try:
                     while True:
                         message = await get_message(websocket)
-                        log_msg(message)
-                        # execute directly to show stack on exceptions
-                        # TODO reenable threading
-                        botcycle.process(message, queue_message)
+                        # processed by the worker threads, in order for each user
+                        dispatcher.submit(message)
+                finally:
+                    sender.cancel()
 
         except websockets.exceptions.ConnectionClosed as e:
             print(e)
@@ -87,10 +85,10 @@ async def main():
         except Exception as e:
             traceback.print_exc()
 
-        time.sleep(2)
+        await asyncio.sleep(2)
 
 
-websocket_path = LANGUAGE + '/' + os.environ.get('WEBSOCKET_PATH', 'main')
+websocket_path = LANGUAGE + '/' + WEBSOCKET_PATH
 websocket_token = os.environ.get(
     'WEBSOCKET_TOKEN', None)
 # the websocket token is compulsory
@@ -0,0 +1,95 @@
+"""
+Call this to measure the bikes module without network: the stations are served
+by a fixtures.FixtureFeed, either synthetic or replayed from a fixture file
+recorded with fixtures.record. For each operation it prints the throughput and
+the p50 / p99 latency.
+
+    python run_bikes_benchmark.py [--fixtures PATH] [--sizes 500,2000,20000] [--queries 10000] [--cycles 5]
+"""
+import os
+import time
+import argparse
+
+# nothing is read from or written to disk by the bikes module
+os.environ['SNAPSHOT_DIR'] = ''
+os.environ['HISTORY_DIR'] = ''
+os.environ['CITY_INDEX_CACHE'] = ''
+
+import numpy as np
+
+from botcycle import bikes
+from botcycle.fixtures import FixtureFeed
+
+
+def report(name, latencies):
+    latencies = np.asarray(latencies)
+    print('{:<28} {:>10.0f} ops/s   p50 {:>9.1f} us   p99 {:>9.1f} us'.format(
+        name, len(latencies) / latencies.sum(), np.percentile(latencies, 50) * 1e6, np.percentile(latencies, 99) * 1e6))
+
+
+def measure(name, function, arguments):
+    latencies = np.empty(len(arguments))
+    for i, args in enumerate(arguments):
+        start = time.perf_counter()
+        function(*args)
+        latencies[i] = time.perf_counter() - start
+    report(name, latencies)
+
+
+def positions_near(metas, count, spread, rng):
+    """count positions around the centers of random cities of metas"""
+    cities = rng.integers(0, len(metas), count)
+    return [{'latitude': float(metas[c]['latitude']) + float(rng.normal(0, spread)),
+             'longitude': float(metas[c]['longitude']) + float(rng.normal(0, spread))} for c in cities]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', help='fixture file to replay, a synthetic feed if missing')
+    parser.add_argument('--sizes', default='500,2000,20000', help='stations of each synthetic city')
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--cycles', type=int, default=5, help='refresh cycles of all the cities')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        feed = FixtureFeed.load(args.fixtures)
+    else:
+        feed = FixtureFeed.synthetic([int(x) for x in args.sizes.split(',')])
+    bikes.use_feed(feed)
+    tags = list(feed.cities.keys())
+    metas = [feed.cities[tag]['meta'] for tag in tags]
+    for tag in tags:
+        print('{}: {} stations'.format(tag, len(feed.cities[tag]['snapshots'][0]['stations'])))
+
+    rng = np.random.default_rng(0)
+    positions = positions_near(metas, args.queries, 0.03, rng)
+    anywhere = [{'latitude': float(rng.uniform(-60, 60)), 'longitude': float(rng.uniform(-180, 180))}
+                for _ in range(args.queries)]
+
+    # get_city also starts tracking the city, so the refresh cycles publish it
+    measure('refresh (cold)', bikes.get_city, [(tag,) for tag in tags])
+    measure('nearest_city_find (any)', bikes.nearest_city_find, [(x,) for x in anywhere])
+    measure('nearest_city_find (cities)', bikes.nearest_city_find, [(x,) for x in positions])
+    measure('get_city_cached', bikes.get_city_cached, [(x,) for x in positions])
+    measure('search_nearest bikes', bikes.search_nearest, [(x, 'bikes') for x in positions])
+    measure('search_nearest slots', bikes.search_nearest, [(x, 'slots') for x in positions])
+    measure('search_nearest arrival', bikes.search_nearest, [(x, 'slots', 15) for x in positions])
+    measure('search_k_nearest k=3', bikes.search_k_nearest, [(x, 'bikes', 3) for x in positions])
+    # the destinations are in the same city as the sources
+    destinations = [{'latitude': x['latitude'] + float(rng.normal(0, 0.02)), 'longitude': x['longitude'] + float(rng.normal(0, 0.02))}
+                    for x in positions]
+    measure('search_trip', bikes.search_trip, [(a, b, 15, 5) for a, b in zip(positions, destinations)])
+
+    cycles = []
+    for _ in range(args.cycles):
+        start = time.perf_counter()
+        bikes.update_data(tags)
+        cycles.append(time.perf_counter() - start)
+    report('refresh cycle (all cities)', cycles)
+    refreshes = [bikes.refresh_stats[tag]['duration'] for tag in tags]
+    print('last refresh of each city: ' + ', '.join('{} {:.1f} ms'.format(tag, d * 1000) for tag, d in zip(tags, refreshes)))
+
+    bikes.refresh_executor.shutdown()
+
+if __name__ == '__main__':
+    main()
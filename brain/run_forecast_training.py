@@ -0,0 +1,31 @@
+"""
+Call this to train the availability forecast models from the history saved by
+the brain. The models are written in FORECAST_DIR and loaded by the brain.
+"""
+import os
+from dotenv import load_dotenv, find_dotenv
+
+# load environment from file if exists
+load_dotenv(find_dotenv())
+
+from botcycle.history import AvailabilityHistory
+from botcycle.forecast import CityModel
+
+# the history saved by the bot of the language, see bikes.py
+HISTORY_DIR = os.environ.get('HISTORY_DIR', os.path.join('history', os.environ.get('BOT_LANGUAGE', 'EN')))
+FORECAST_DIR = os.environ.get('FORECAST_DIR', 'forecast')
+
+
+def main():
+    history = AvailabilityHistory(float(os.environ.get('HISTORY_DAYS', 7)),
+                                  float(os.environ.get('HISTORY_SAMPLE_INTERVAL', 300)))
+    history.load(HISTORY_DIR)
+    os.makedirs(FORECAST_DIR, exist_ok=True)
+
+    for tag, city_history in history.cities.items():
+        model = CityModel.train(city_history)
+        model.save(os.path.join(FORECAST_DIR, tag + '.npz'))
+        print('trained {} on {} samples of {} stations'.format(tag, city_history.count, len(city_history.names)))
+
+if __name__ == '__main__':
+    main()